@@ -1,13 +1,14 @@
 import collections
 from .helpers import product_dict, merge_dicts
 from pathlib import Path
-from schema import Schema, Or
+from schema import Schema, Or, Optional
 import lib.sqlite_bench
 import lib.rocksdb_bench
 import lib.sysbench_mariadb
 import lib.redis_benchmark
 import lib.filebench
 import lib.fio
+from lib.fio_jsonplus import LatencyHistogram
 from contextlib import ExitStack
 
 from .helpers import string_with_one_format_placeholder
@@ -35,9 +36,10 @@ class Dummy():
         emit_result({"dummy": "dummy"})
 
 class Filebench(Benchmark):
+    KwargsSchema = Schema({"identity": str, "workload": str, "vars": {str: list}})
 
     def __init__(self, **kwargs):
-        super().__init__(Schema({"identity": str, "workload": str, "vars": {str: list}}), kwargs)
+        super().__init__(self.KwargsSchema, kwargs)
 
     def run(self, dir, emit_result):
         for vars in product_dict(self.vars):
@@ -58,8 +60,10 @@ class Filebench(Benchmark):
 
 
 class SqliteBench(Benchmark):
+    KwargsSchema = Schema({"num": int})
+
     def __init__(self, **kwargs):
-        super().__init__(Schema({"num": int}), kwargs)
+        super().__init__(self.KwargsSchema, kwargs)
 
     def run(self, dir, emit_result):
         config = {
@@ -76,9 +80,10 @@ class SqliteBench(Benchmark):
         })
 
 class RocksdbBench(Benchmark):
+    KwargsSchema = Schema({"num": int, "nthreads": [int]})
 
     def __init__(self, **kwargs):
-        super().__init__(Schema({"num": int, "nthreads": [int]}), kwargs)
+        super().__init__(self.KwargsSchema, kwargs)
 
     def run(self, dir, emit_result):
         for nthreads in self.nthreads:
@@ -100,8 +105,10 @@ class RocksdbBench(Benchmark):
 
 
 class RedisSetBench(Benchmark):
+    KwargsSchema = Schema({"nthreads_nclients": [int]})
+
     def __init__(self, **kwargs):
-        super().__init__(Schema({"nthreads_nclients": [int]}), kwargs)
+        super().__init__(self.KwargsSchema, kwargs)
 
     def run(self, dir, emit_result):
         for nthreads_nclients in self.nthreads_nclients:
@@ -133,8 +140,10 @@ class RedisSetBench(Benchmark):
 
 
 class MariaDbSysbenchOltpInsert(Benchmark):
+    KwargsSchema = Schema({"nthreads": [int]})
+
     def __init__(self, **kwargs):
-        super().__init__(Schema({"nthreads": [int]}), kwargs)
+        super().__init__(self.KwargsSchema, kwargs)
 
     def run(self, dir, emit_result):
         for nthreads in self.nthreads:
@@ -169,47 +178,58 @@ class FioAnalyzer:
         return Result()
 
 class Fio4kSyncRandFsWrite(Benchmark):
+    KwargsSchema = Schema({
+        "store": object,
+        "identity": str,
+        "numjobs_values": [int],
+        "size": int,
+        "size_mode": Or("size-per-job", "size-div-by-numjobs"),
+        "dir_is_mountpoint_format_string": bool,
+        "runtime_seconds": int,
+        Optional("timeseries", default=None): object, # see lib.fio.FioBenchmarkConfig
+        # see lib.fio.FioBenchmarkConfig, runtime_seconds becomes the upper bound
+        Optional("adaptive_runtime", default=None): object,
+        # reuse: lay out the work files for max(numjobs_values) once and reuse them for all numjobs values
+        Optional("prewrite_mode", default="delete"): Or("delete", "reuse"),
+    })
+
     def __init__(self, **kwargs):
-        super().__init__(Schema({
-            "store": object,
-            "identity": str,
-            "numjobs_values": [int],
-            "size": int,
-            "size_mode": Or("size-per-job", "size-div-by-numjobs"),
-            "dir_is_mountpoint_format_string": bool,
-            "runtime_seconds": int,
-        }), kwargs)
+        super().__init__(self.KwargsSchema, kwargs)
+
+    def _size(self, numjobs):
+        if self.size_mode == "size-per-job":
+            return self.size
+        elif self.size_mode == "size-div-by-numjobs":
+            size = self.size // numjobs
+            # align to 2 MiB because that's what fio's devdax engine requires
+            ## Otherwise it fails with with status code 3
+            ## and dmesg says
+            ## dax_mmap: fail, unaligned vma (0x7ff0ece00000 - 0x7ff102356000, 0x1fffff)
+            ## => linux kernel: drivers/dax/device.c
+            # FIXME: we should get the alignment requirement info from somewhere else
+            assert size >= (1<<22)
+            size = size & (~((1<<22)- 1))
+            assert size > 0
+            return size
+        raise Exception(f"unknown size_mode {self.size_mode}")
 
     def run(self, dir, emit_result, setup_analyzers=None, fio_target_override=None):
 
+        base_fio_config = {
+            "fio_binary": Path(self.store.get_one('fio_binary')),
+            "blocksize": 1<<12, # keep in sync with zfs recordsize prop!
+            "runtime_seconds": self.runtime_seconds,
+            "ramp_seconds": 2,
+            "fsync_every": 0,
+            "sync": 1,
+            "timeseries": self.timeseries,
+            "adaptive_runtime": self.adaptive_runtime,
+        }
+
         for numjobs in self.numjobs_values:
-            fio_config = {}
-            fio_config = merge_dicts(fio_config, {
-			    "fio_binary": Path(self.store.get_one('fio_binary')),
-                "blocksize": 1<<12, # keep in sync with zfs recordsize prop!
-                "runtime_seconds": self.runtime_seconds,
-                "ramp_seconds": 2,
-                "fsync_every": 0,
+            fio_config = merge_dicts(base_fio_config, {
                 "numjobs": numjobs,
-                "sync": 1,
-            })
-
-            if self.size_mode == "size-per-job":
-                size = self.size
-            elif self.size_mode == "size-div-by-numjobs":
-                size = self.size // numjobs
-                # align to 2 MiB because that's what fio's devdax engine requires
-                ## Otherwise it fails with with status code 3
-                ## and dmesg says
-                ## dax_mmap: fail, unaligned vma (0x7ff0ece00000 - 0x7ff102356000, 0x1fffff)
-                ## => linux kernel: drivers/dax/device.c
-                # FIXME: we should get the alignment requirement info from somewhere else
-                assert size >= (1<<22)
-                size = size & (~((1<<22)- 1))
-                assert size > 0
-
-            fio_config = merge_dicts(fio_config, {
-                "size": size,
+                "size": self._size(numjobs),
             })
 
             # compute and set 'target' config item
@@ -227,8 +247,14 @@ class Fio4kSyncRandFsWrite(Benchmark):
                     "type": "fs",
                     "filename_format_str": filename_format_str,
                     "require_filename_format_str_parent_is_mountpoint": require_mountpoint,
-                    "prewrite_mode": "delete",
+                    "prewrite_mode": self.prewrite_mode,
                 }
+                if self.prewrite_mode == "reuse":
+                    # with size-div-by-numjobs, runs with more jobs use a prefix of each file
+                    fio_target["reuse_pool"] = {
+                        "nfiles": max(self.numjobs_values),
+                        "file_size": max(self._size(n) for n in self.numjobs_values),
+                    }
             fio_config = merge_dicts(fio_config, { "target": fio_target })
 
             # fio config done, now setup analyzers and start the benchmark
@@ -244,7 +270,7 @@ class Fio4kSyncRandFsWrite(Benchmark):
 
                 analyzers = setup_analyzers(setup_teardown_stack)
 
-                after_fio_exit_stack = ExitStack()
+                after_timed_phase_stack = ExitStack()
                 def after_rampup():
                     with ExitStack() as stack:
                         # start all measurements and register a callback to end them
@@ -254,20 +280,29 @@ class Fio4kSyncRandFsWrite(Benchmark):
                                 m.end()
                                 result[result_dict_key] = m.result()
                             stack.callback(end_and_add_to_results, m, result_dict_key)
-                        # if we could start all measurements, shift the callback invocation to `after_fio_exit`
-                        after_fio_exit_stack.push(stack.pop_all())
-                def after_fio_exit():
-                    after_fio_exit_stack.close()
+                        # if we could start all measurements, shift the callback invocation to `after_timed_phase`
+                        after_timed_phase_stack.push(stack.pop_all())
+                def after_timed_phase():
+                    after_timed_phase_stack.close()
 
                 fiojson = lib.fio.run(
                         fio_config,
                         call_after_rampup=after_rampup,
-                        call_after_fio_exit=after_fio_exit)
+                        call_after_timed_phase=after_timed_phase)
 
                 # add fio results to results dict and emit it
-                result = merge_dicts(result, {
+                # (no merge_dicts, that would copy the json+ output for nothing, the keys are new)
+                result.update({
                     "fio_config": fio_config,
                     "fio_jsonplus": fiojson,
+                    "clat_histogram": LatencyHistogram.from_jsonplus(fiojson).to_dict(),
                 })
                 emit_result(result)
 
+    @staticmethod
+    def clat_histogram(result):
+        """LatencyHistogram of a result emitted by run(), also works for results that predate the clat_histogram key"""
+        if "clat_histogram" in result:
+            return LatencyHistogram.from_dict(result["clat_histogram"])
+        return LatencyHistogram.from_jsonplus(result["fio_jsonplus"])
+
@@ -1,19 +1,45 @@
-from schema import Schema, Or
+from schema import Schema, Or, And, Optional
 from pathlib import Path
 
 import matplotlib.pyplot as plt
 import matplotlib
+import matplotlib.cbook
+import matplotlib.transforms
 import seaborn as sns
+import atexit
+import concurrent.futures
+import copyreg
+import hashlib
+import io
+import os
+import pickle
+import threading
+
+SAVEFIG_FORMATS = [
+    # ("png", 100, ".100dpi.png"),
+    # ("png", 200, ".200dpi.png"),
+    # ("png", 300, ".300dpi.png"),
+    # ("png", 400, ".400dpi.png"),
+    ("pdf", 300, ".pdf"),
+]
 
 ConfigSchema = Schema({
     "seaborn_context": Or("talk", "notebook", "paper", "poster"),
     "savefig": {
         "dir": Path,
         "enable": bool,
+        # (format, dpi, suffix)
+        Optional("formats", default=SAVEFIG_FORMATS): [And((str, int), lambda t: len(t) == 3)],
+        # render in a background process pool, see wait()
+        Optional("async", default=False): bool,
+        Optional("workers", default=None): Or(None, And(int, lambda n: n > 0)),
     }
 })
 
 _config = None
+_executor = None
+_pending = []
+_pending_lock = threading.Lock()
 
 def setup(config):
     global _config
@@ -34,19 +60,119 @@ def setup(config):
         raise Exception(f"savefig.dir={config['savefig']['dir']} must be a directory")
 
 
-def savefig(name: str):
+class _FigureHashPickler(pickle.Pickler):
+    """pickles a figure deterministically (across processes) for hashing purposes only"""
+
+    def reducer_override(self, obj):
+        # the cid counter advances on every pickle
+        if isinstance(obj, matplotlib.cbook.CallbackRegistry):
+            return (str, ("CallbackRegistry",))
+        # _parents is keyed by id() and only holds back-references of the children
+        if isinstance(obj, matplotlib.transforms.TransformNode):
+            state = obj.__getstate__()
+            state.pop("_parents", None)
+            return (copyreg.__newobj__, (type(obj),), state)
+        return NotImplemented
+
+def _render_rcparams():
+    rc = dict(matplotlib.rcParams)
+    rc.pop("backend", None)
+    return rc
+
+def figure_sha256(fig, rc):
+    """hash of the figure's data and styling, stable across kernel restarts
+
+    None if the figure can't be pickled (e.g. a FuncFormatter with a lambda).
+    """
+    f = io.BytesIO()
+    try:
+        _FigureHashPickler(f, protocol=4).dump((fig, sorted(rc.items())))
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        print(f"savefig: can't hash figure, always re-rendering it: {e}")
+        return None
+    return hashlib.sha256(f.getvalue()).hexdigest()
+
+def _stamp_path(p: Path):
+    return p.parent / ".savefig" / f"{p.name}.sha256"
+
+def _is_up_to_date(p: Path, sha256):
+    stamp = _stamp_path(p)
+    return p.exists() and stamp.exists() and stamp.read_text() == sha256
+
+def _write_stamp(p: Path, sha256):
+    stamp = _stamp_path(p)
+    stamp.parent.mkdir(exist_ok=True)
+    tmp = stamp.with_name(f"{stamp.name}.{os.getpid()}.tmp")
+    tmp.write_text(sha256)
+    os.replace(tmp, stamp)
+
+def _render(fig, rc, p: Path, format, dpi):
+    if isinstance(fig, bytes):
+        fig = pickle.loads(fig)
+    with matplotlib.rc_context(rc):
+        fig.savefig(p, format=format, dpi=dpi, pad_inches=0.02, bbox_inches='tight')
+
+def _render_worker_init():
+    matplotlib.use("Agg")
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=_config["savefig"]["workers"],
+            initializer=_render_worker_init,
+        )
+        atexit.register(wait)
+    return _executor
+
+def savefig(name: str, fig=None):
+    """save `fig` (default: the current figure) in all configured formats
+
+    Outputs whose figure hash didn't change since the last save are not re-rendered (unpicklable figures always are).
+    With savefig.async, rendering happens in a background process pool; call wait() before relying on the files.
+    The figure must be picklable for that.
+    """
     global _config
 
     if not _config["savefig"]["enable"]:
         return
 
-    formats = [
-        # ("png", 100, ".100dpi.png"),
-        # ("png", 200, ".200dpi.png"),
-        # ("png", 300, ".300dpi.png"),
-        # ("png", 400, ".400dpi.png"),
-        ("pdf", 300, ".pdf"),
-    ]
-    for format, dpi, suffix in formats:
+    if fig is None:
+        fig = plt.gcf()
+    rc = _render_rcparams()
+    fig_sha256 = figure_sha256(fig, rc)
+    fig_pickle = None
+
+    for format, dpi, suffix in _config["savefig"]["formats"]:
         p = (_config["savefig"]["dir"] / name).with_suffix(suffix)
-        plt.savefig(p, format=format, dpi=dpi, pad_inches=0.02, bbox_inches='tight')
+        if fig_sha256 is None and not _config["savefig"]["async"]:
+            _stamp_path(p).unlink(missing_ok=True)
+            _render(fig, rc, p, format, dpi)
+            continue
+        sha256 = hashlib.sha256(f"{fig_sha256}:{format}:{dpi}".encode("utf-8")).hexdigest()
+        if _is_up_to_date(p, sha256):
+            continue
+        if not _config["savefig"]["async"]:
+            _render(fig, rc, p, format, dpi)
+            _write_stamp(p, sha256)
+            continue
+        if fig_pickle is None:
+            # snapshot now, the notebook may continue to modify the figure
+            fig_pickle = pickle.dumps(fig)
+        future = _get_executor().submit(_render, fig_pickle, rc, p, format, dpi)
+        future.add_done_callback(lambda f, p=p, sha256=sha256: f.exception() is None and _write_stamp(p, sha256))
+        with _pending_lock:
+            _pending.append((p, future))
+
+def wait():
+    """wait for all figures submitted with savefig.async to be rendered, raise if any failed"""
+    with _pending_lock:
+        pending = list(_pending)
+        _pending.clear()
+    failed = []
+    for p, future in pending:
+        e = future.exception()
+        if e is not None:
+            failed.append((p, e))
+    if failed:
+        raise Exception(f"rendering failed: {failed}")
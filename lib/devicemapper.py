@@ -1,6 +1,6 @@
 from schema import Schema, And, Optional
 import subprocess
-from .helpers import AttrDict, must_run, poll_wait, zero_out_first_sector, is_p2
+from .helpers import AttrDict, must_run, wait_for_path, zero_out_first_sector, is_p2, CachedSchema
 from pathlib import Path
 
 SECTOR_SHIFT = 9
@@ -28,23 +28,27 @@ class StructuredTable(Table):
     def to_dmsetup_table(self):
         return "\n".join([e.to_dmsetup_table_row() for e in self.entries])
 
+TableEntrySchema = CachedSchema(Schema({
+    "start_sector": int,
+    "num_sectors": int,
+    "constructor": [str],
+}))
+
 class TableEntry:
     def __init__(self, **kwargs):
-        self.config = AttrDict(Schema({
-            "start_sector": int,
-            "num_sectors": int,
-            "constructor": [str],
-        }).validate(kwargs))
+        self.config = AttrDict(TableEntrySchema.validate(kwargs))
 
     def to_dmsetup_table_row(self):
         return " ".join([f"{self.config.start_sector}", f"{self.config.num_sectors}", *self.config.constructor])
 
 
+AbstractTargetSchema = CachedSchema(Schema({
+    "name": str,
+}))
+
 class AbstractTarget:
     def __init__(self, **kwargs):
-        kwargs = AttrDict(Schema({
-              "name": str,
-          }).validate(kwargs))
+        kwargs = AttrDict(AbstractTargetSchema.validate(kwargs))
         self.name = kwargs.name
 
     def _path(self):
@@ -75,12 +79,12 @@ class AbstractTarget:
         except subprocess.CalledProcessError as e:
             raise Exception("cannot create target, consider checking dmesg") from e
 
-        poll_wait(0.1, self._path().exists, f"blockdev {self._path()} to appear")
+        wait_for_path(self._path(), what=f"blockdev {self._path()} to appear")
 
     def teardown(self):
         cmd = ["dmsetup", "remove", "--retry", self.name]
         must_run(cmd)
-        poll_wait(0.1, lambda: not self._path().exists(), f"blockdev {self._path()} to disappear")
+        wait_for_path(self._path(), present=False, what=f"blockdev {self._path()} to disappear")
 
     def __enter__(self):
         self.setup()
@@ -91,38 +95,45 @@ class AbstractTarget:
 
 
 # https://www.kernel.org/doc/html/latest/admin-guide/device-mapper/linear.html
+# not cached: checks the device
+SimpleLinearTableConfigSchema = Schema({
+    "size": And(int, is_sector_multiple),
+    "device": And(Path, Path.is_block_device),
+})
+
 def simple_linear_table(config):
-    config = AttrDict(Schema({
-        "size": And(int, is_sector_multiple),
-        "device": And(Path, Path.is_block_device),
-    }).validate(config))
+    config = AttrDict(SimpleLinearTableConfigSchema.validate(config))
     return RawTable(f"0 {size_to_sectors(config.size)} linear {config.device} 0")
 
 
+TargetSchema = Schema({
+    "name": str,
+    "table": Table,
+})
+
 class Target(AbstractTarget):
     def __init__(self, **kwargs):
-        kwargs = AttrDict(Schema({
-            "name": str,
-            "table": Table,
-        }).validate(kwargs))
+        kwargs = AttrDict(TargetSchema.validate(kwargs))
         self.table = kwargs.table
         super().__init__(name=kwargs.name)
 
+WritecachePmemConfigSchema = CachedSchema(Schema({
+    "name": str,
+    "size": And(int, is_sector_multiple),
+    "blocksize": And(int, is_p2),
+    "origin_device": Path,
+    "cache_device": Path,
+    Optional("options", default={}): {
+        Optional("high_watermark"): int, # percentage
+        Optional("low_watermark"): int, # percentage,
+        # ...
+    }
+}))
+
 # https://www.kernel.org/doc/html/latest/admin-guide/device-mapper/writecache.html
 class WritecachePmem(AbstractTarget):
     def __init__(self, config):
-        config = AttrDict(Schema({
-            "name": str,
-            "size": And(int, is_sector_multiple),
-            "blocksize": And(int, is_p2),
-            "origin_device": Path,
-            "cache_device": Path,
-            Optional("options", default={}): {
-                Optional("high_watermark"): int, # percentage
-                Optional("low_watermark"): int, # percentage,
-                # ...
-            }
-        }).validate(config))
+        config = AttrDict(WritecachePmemConfigSchema.validate(config))
 
         assert "nvme0" not in str(config.origin_device)
         assert "nvme0" not in str(config.cache_device)
@@ -139,12 +150,15 @@ class WritecachePmem(AbstractTarget):
         for d in self.__prezero:
             zero_out_first_sector(d)
 
+# not cached: checks the devices
+StripeConfigSchema = Schema({
+    "name": str,
+    "blockdevs": [And(Path, Path.is_block_device)],
+})
+
 class Stripe(AbstractTarget):
     def __init__(self, config):
-        config = AttrDict(Schema({
-            "name": str,
-            "blockdevs": [And(Path, Path.is_block_device)],
-        }).validate(config))
+        config = AttrDict(StripeConfigSchema.validate(config))
 
         self.blockdevs = config.blockdevs
         for bd in self.blockdevs:
@@ -1,8 +1,17 @@
-from .helpers import string_with_one_format_placeholder, is_p2, merge_dicts, must_run
-from schema import Schema, And, Or
+from .helpers import string_with_one_format_placeholder, is_p2, merge_dicts, must_run, StreamingProcess, CachedSchema
+from .fio_timeseries import LogCollector, fio_log_args
+from schema import Schema, And, Or, Optional
 from pathlib import Path
 import dictlib
+import collections
 import json
+import math
+import os
+import re
+import scipy.stats
+import signal
+import statistics
+import subprocess
 import tempfile
 import threading
 import time
@@ -13,7 +22,12 @@ TargetFsConfigSchema = Schema({
     "type": "fs",
     "filename_format_str": And(string_with_one_format_placeholder, lambda s: "$" not in s),
     "require_filename_format_str_parent_is_mountpoint": bool,
-    "prewrite_mode": Or("delete", "prewrite")
+    # reuse: keep a pool of work files (see _reuse_workfile_pool) across runs
+    "prewrite_mode": Or("delete", "prewrite", "reuse"),
+    Optional("reuse_pool", default=None): Or(None, {
+        "nfiles": And(int, lambda n: n > 0),
+        "file_size": And(int, lambda n: n > 0),
+    }),
 })
 
 TargetDevdaxConfigSchema = Schema({
@@ -25,7 +39,8 @@ TargetBlockdevConfigSchema = Schema({
     "type": "blockdev",
     "blockdev_path": Path,
 })
-FioBenchmarkConfig = Schema({
+# validated on every run, usually with the same config for each storage stack
+FioBenchmarkConfig = CachedSchema(Schema({
     "fio_binary": Path,
     "blocksize": And(int, is_p2),
     "size": And(int),
@@ -35,9 +50,181 @@ FioBenchmarkConfig = Schema({
     "runtime_seconds": And(int, lambda n: n > 0),
     "ramp_seconds": And(int, lambda n: n >= 0),
     "target": Or(TargetFsConfigSchema, TargetBlockdevConfigSchema, TargetDevdaxConfigSchema),
-})
-
-def _run_fio(config, config_overrides, append_cmdline, call_after_rampup=None, call_after_fio_exit=None):
+    # opt-in: fio bw / iops / lat logs, down-sampled to at most max_points per series, see lib.fio_timeseries
+    Optional("timeseries", default=None): Or(None, {
+        "log_avg_msec": And(int, lambda n: n > 0),
+        "max_points": And(int, lambda n: n >= 2),
+    }),
+    # opt-in: stop fio (at the latest after runtime_seconds) once the confidence interval of the mean write IOPS
+    # (batch means over fio's eta output) is narrower than ci_rel_width * mean
+    Optional("adaptive_runtime", default=None): Or(None, {
+        "ci_rel_width": And(float, lambda x: 0 < x < 1),
+        Optional("confidence", default=0.95): And(float, lambda x: 0 < x < 1),
+        Optional("batch_seconds", default=2.0): And(Or(int, float), lambda x: x > 0),
+        Optional("min_batches", default=10): And(int, lambda n: n >= 2),
+    }),
+}))
+
+# run states in fio's --eta status lines, see "Interpreting the output" in the fio HOWTO
+RUNSTATES_BEFORE_TIMED_PHASE = set("PCIp/") # '/' is ramp
+RUNSTATES_TIMED_PHASE = set("RrWwMmDdV")
+ETA_RUNSTATES_RE = re.compile(r"^Jobs: \d+ \(f=\d+\): \[(?P<runstates>[^\]]*)\]")
+ETA_RUNSTATE_RE = re.compile(r"^(?P<state>.)(?:\((?P<count>\d+)\))?$")
+
+def parse_eta_runstates(line):
+    """per-thread run states of a fio eta line (e.g. '[_(6),w(3)]' => '______www'), or None if it isn't one"""
+    m = ETA_RUNSTATES_RE.match(line)
+    if not m:
+        return None
+    states = ""
+    for item in m.group("runstates").split(","):
+        sm = ETA_RUNSTATE_RE.match(item)
+        if not sm:
+            return None
+        states += sm.group("state") * int(sm.group("count") or 1)
+    return states
+
+class FioPhaseTracker:
+    """derives the end of ramp-up and the end of the timed phase from fio's eta lines"""
+
+    def __init__(self):
+        self.rampup_done = threading.Event()
+        self.timed_phase_done = threading.Event()
+
+    def feed(self, line):
+        """returns False if `line` isn't an eta line"""
+        states = parse_eta_runstates(line)
+        if states is None:
+            return False
+        if not states:
+            return True
+        if any(s in RUNSTATES_BEFORE_TIMED_PHASE for s in states):
+            return True
+        # all threads left ramp-up
+        self.rampup_done.set()
+        if not any(s in RUNSTATES_TIMED_PHASE for s in states):
+            # all threads are in end_fsync, finishing or reaped
+            self.timed_phase_done.set()
+        return True
+
+    def fio_exited(self):
+        self.rampup_done.set()
+        self.timed_phase_done.set()
+
+def _test_phase_tracker():
+    assert parse_eta_runstates("Jobs: 9 (f=9): [_(6),w(3)][10.0%][w=1470MiB/s][w=376k IOPS][eta 00m:54s]") == "______www"
+    assert parse_eta_runstates("Jobs: 1 (f=1): [/][eta 00m:54s]") == "/"
+    assert parse_eta_runstates("fio: some warning") is None
+    t = FioPhaseTracker()
+    for line, rampup_done, timed_phase_done in [
+            ("Jobs: 2 (f=2): [/(2)][1.0%][eta 01m:00s]", False, False),
+            ("Jobs: 2 (f=2): [w,/][2.0%][eta 01m:00s]", False, False),
+            ("Jobs: 2 (f=2): [w(2)][3.0%][w=1470MiB/s][w=376k IOPS][eta 00m:58s]", True, False),
+            ("Jobs: 2 (f=2): [F,w][99.0%][w=1470MiB/s][w=376k IOPS][eta 00m:01s]", True, False),
+            ("Jobs: 1 (f=1): [F,_][100.0%][eta 00m:00s]", True, True),
+        ]:
+        assert t.feed(line)
+        assert t.rampup_done.is_set() == rampup_done
+        assert t.timed_phase_done.is_set() == timed_phase_done
+_test_phase_tracker()
+
+ETA_IOPS_RE = re.compile(r"\[(?P<rates>[^\]]*) IOPS\]")
+SI_SUFFIXES = {"": 1, "k": 1e3, "M": 1e6, "G": 1e9, "T": 1e12, "P": 1e15}
+
+def parse_eta_iops(line):
+    """{"r": ..., "w": ...} IOPS of a fio eta line (e.g. '[r=1.2k,w=376k IOPS]'), or None"""
+    m = ETA_IOPS_RE.search(line)
+    if not m:
+        return None
+    ret = {}
+    for item in m.group("rates").split(","):
+        ddir, value = item.strip().split("=")
+        vm = re.match(r"^(?P<num>[\d.]+)(?P<suffix>[kMGTP]?)$", value)
+        if not vm:
+            return None
+        ret[ddir] = float(vm.group("num")) * SI_SUFFIXES[vm.group("suffix")]
+    return ret
+
+class IopsConvergence:
+    """batch means confidence interval over the write IOPS samples of fio's eta lines"""
+
+    def __init__(self, config):
+        self.config = config
+        self.batch_means = []
+        self._batch = []
+        self._batch_start = None
+        self.start = None
+        self.converged_after = None
+
+    def _ci(self):
+        n = len(self.batch_means)
+        mean = statistics.mean(self.batch_means)
+        stdev = statistics.stdev(self.batch_means)
+        halfwidth = scipy.stats.t.ppf((1 + self.config["confidence"]) / 2, n - 1) * stdev / math.sqrt(n)
+        return mean, halfwidth
+
+    def feed(self, line, now):
+        """returns True once converged"""
+        if self.converged_after is not None:
+            return True
+        iops = parse_eta_iops(line)
+        if iops is None or "w" not in iops:
+            return False
+        if self.start is None:
+            self.start = now
+            self._batch_start = now
+        if now - self._batch_start >= self.config["batch_seconds"]:
+            if self._batch:
+                self.batch_means.append(statistics.mean(self._batch))
+            self._batch = []
+            self._batch_start = now
+            if len(self.batch_means) >= self.config["min_batches"]:
+                mean, halfwidth = self._ci()
+                if mean > 0 and 2 * halfwidth / mean <= self.config["ci_rel_width"]:
+                    self.converged_after = now - self.start
+                    return True
+        self._batch.append(iops["w"])
+        return False
+
+    def to_dict(self):
+        d = {
+            "config": self.config,
+            "converged": self.converged_after is not None,
+            "converged_after_seconds": self.converged_after,
+            "batch_means": self.batch_means,
+        }
+        if len(self.batch_means) >= 2:
+            mean, halfwidth = self._ci()
+            d.update({"mean": mean, "ci_halfwidth": halfwidth, "ci_rel_width": 2 * halfwidth / mean if mean else None})
+        return d
+
+def _test_iops_convergence():
+    assert parse_eta_iops("Jobs: 9 (f=9): [w(9)][10.0%][w=1470MiB/s][w=376k IOPS][eta 00m:54s]") == {"w": 376e3}
+    assert parse_eta_iops("Jobs: 1 (f=1): [m(1)][1%][r=1.5k,w=12 IOPS][eta 1m]") == {"r": 1.5e3, "w": 12}
+    assert parse_eta_iops("Jobs: 1 (f=1): [w(1)][eta 00m:54s]") is None
+    c = IopsConvergence({"ci_rel_width": 0.01, "confidence": 0.95, "batch_seconds": 1, "min_batches": 3})
+    line = lambda iops: f"Jobs: 1 (f=1): [w(1)][1.0%][w={iops} IOPS][eta 00m:54s]"
+    t = 0
+    converged = False
+    for i in range(100):
+        converged = c.feed(line(1000 + (i % 2)), t)
+        if converged:
+            break
+        t += 0.25
+    assert converged and 3 <= len(c.batch_means) <= 5
+    assert c.to_dict()["converged"] and c.to_dict()["ci_rel_width"] <= 0.01
+    # noisy: doesn't converge
+    c = IopsConvergence({"ci_rel_width": 0.01, "confidence": 0.95, "batch_seconds": 1, "min_batches": 3})
+    assert not any(c.feed(line(1000 * (1 + (i // 4) % 3)), i * 0.25) for i in range(100))
+    assert not c.to_dict()["converged"]
+_test_iops_convergence()
+
+def _run_fio(config, config_overrides, append_cmdline, call_after_rampup=lambda: None, call_after_timed_phase=lambda: None, create_files=True):
+    """run fio, invoking call_after_rampup when all jobs left ramp-up and call_after_timed_phase when they left
+    the timed phase (i.e., before end_fsync), as reported by fio's eta output
+
+    create_files=False skips the --create_only pass, for work files that are known to be laid out already.
+    """
     config = merge_dicts(config, config_overrides)
 
     output_filename = "fio-output.json"
@@ -68,35 +255,77 @@ def _run_fio(config, config_overrides, append_cmdline, call_after_rampup=None, c
         f"--output={output_filename}",
 
         *append_cmdline
-        # TODO
-        # write_bw_logs
-        # write_iops_logs
     ]
 
-    starting_fio_event = threading.Event()
-    fio_exited_or_panicked = threading.Event()
+    timeseries_log_prefix = "fio-timeseries"
+    if config["timeseries"]:
+        args += fio_log_args(timeseries_log_prefix, config["timeseries"]["log_avg_msec"])
+
+    # status lines on stdout, used to track ramp-up and timed phase
+    status_args = ["--eta=always", "--eta-interval=250ms"]
+
+    phases = FioPhaseTracker()
+    convergence = IopsConvergence(config["adaptive_runtime"]) if config["adaptive_runtime"] else None
 
     def run_fio_thread():
+        try:
+            return run_fio()
+        finally:
+            # unblock the callback logic below, whatever happened
+            phases.fio_exited()
+
+    def run_fio():
         tempdir = tempfile.TemporaryDirectory(prefix="run_fio_benchmark_", suffix="__run_fio")
         d = Path(tempdir.name)
         assert len(list(d.iterdir())) == 0
 
-        print("setup files")
-        must_run(args + ["--create_only=1"], cwd=d)
+        if create_files:
+            print("setup files")
+            must_run(args + ["--create_only=1"], cwd=d)
+
+        timeseries = None
+        if config["timeseries"]:
+            timeseries = LogCollector(d, timeseries_log_prefix, config["timeseries"]["log_avg_msec"], config["timeseries"]["max_points"])
+            timeseries.start()
 
         print("starting fio")
-        starting_fio_event.set()
+        output_tail = collections.deque(maxlen=100)
+        stopped = False
         try:
-            must_run(args, cwd=d)
-        except:
-            raise
+            # fio terminates eta lines with \r unless --eta-newline is given
+            # the tail of non-eta lines is kept separately below, so that eta lines don't push the interesting parts out
+            with StreamingProcess(args + status_args, sink=None, tail_lines=0, sep=rb"[\r\n]", check=False, cwd=d) as p:
+                for line in p:
+                    line = line.rstrip("\r\n")
+                    if not line:
+                        continue
+                    if not phases.feed(line):
+                        output_tail.append(line)
+                        continue
+                    if not convergence or stopped or not phases.rampup_done.is_set() or phases.timed_phase_done.is_set():
+                        continue
+                    if convergence.feed(line, time.monotonic()):
+                        print(f"IOPS converged after {convergence.converged_after:.1f}s, stopping fio")
+                        # fio terminates the jobs and still writes its output
+                        p.send_signal(signal.SIGINT)
+                        stopped = True
+            if p.returncode != 0 and not (stopped and (d / output_filename).exists()):
+                output = "\n".join(output_tail)
+                print(f"fio exited with status {p.returncode}, output:\n{output}")
+                raise subprocess.CalledProcessError(p.returncode, args, output=output)
         finally:
-            fio_exited_or_panicked.set()
+            if timeseries:
+                timeseries.stop()
 
         output_filepath = d / output_filename
         assert output_filepath.exists()
         with open(output_filepath, "r") as f:
             ret = json.load(f)
+        # fio's json output never has these keys
+        if timeseries:
+            ret["timeseries"] = timeseries.to_dict()
+        if convergence:
+            ret["adaptive_runtime"] = convergence.to_dict()
         tempdir.cleanup()
         return ret
 
@@ -104,21 +333,13 @@ def _run_fio(config, config_overrides, append_cmdline, call_after_rampup=None, c
     with concurrent.futures.ThreadPoolExecutor() as executor:
         fio = executor.submit(run_fio_thread)
         try:
-            # wait for fio to start
-            starting_fio_event.wait()
-            # now wait for rampup time to pass
-            # (this is somewhat accurate because we
-            # run fio with --create_only before
-            # we trigger the event)
-            time.sleep(config["ramp_seconds"])
-
+            phases.rampup_done.wait() # guaranteed to be set, see run_fio_thread
             with ExitStack() as stack:
-                # now invoke the post-rampup pre exec callback
+                # now invoke the post-rampup callback
                 call_after_rampup()
-                # and queue the post-exit callback
-                stack.callback(call_after_fio_exit)
-                # then wait for fio to exit
-                fio_exited_or_panicked.wait() # this is guaranteed to bet set, see above
+                # and queue the end-of-timed-phase callback
+                stack.callback(call_after_timed_phase)
+                phases.timed_phase_done.wait() # guaranteed to be set, see run_fio_thread
 
             return fio.result()
         except:
@@ -126,6 +347,93 @@ def _run_fio(config, config_overrides, append_cmdline, call_after_rampup=None, c
             fio.result()
             raise
 
+WORKFILE_POOL_MARKER_VERSION = 1
+
+def _workfile_pool_marker_path(workfile_path: Path):
+    return workfile_path.with_name(workfile_path.name + ".fio_pool_marker")
+
+def _workfile_pool_marker(config):
+    # blocksize: the filesystem allocator might allocate differently depending on the blocksize used for layout
+    return {
+        "version": WORKFILE_POOL_MARKER_VERSION,
+        "blocksize": config["blocksize"],
+        "file_size": config["target"]["reuse_pool"]["file_size"],
+    }
+
+def _workfile_pool_is_laid_out(config, workfile_paths):
+    marker = _workfile_pool_marker(config)
+    for p in workfile_paths:
+        m = _workfile_pool_marker_path(p)
+        if not (p.is_file() and m.is_file()):
+            return False
+        if json.loads(m.read_text()) != marker or p.stat().st_size != marker["file_size"]:
+            return False
+    return True
+
+def _reuse_workfile_pool(config, filename_format):
+    """make sure the pool's work files are laid out
+
+    The pool consists of reuse_pool.nfiles files of reuse_pool.file_size bytes, a run with numjobs=N uses the first N.
+    Each file has a marker file that is written after the files were laid out and synced.
+    """
+    pool = config["target"]["reuse_pool"]
+    if config["numjobs"] > pool["nfiles"]:
+        raise Exception(f"numjobs={config['numjobs']} exceeds reuse_pool.nfiles={pool['nfiles']}")
+    if config["size"] > pool["file_size"]:
+        raise Exception(f"size={config['size']} exceeds reuse_pool.file_size={pool['file_size']}")
+
+    pool_paths = [Path(filename_format.format(i)) for i in range(0, pool["nfiles"])]
+    if _workfile_pool_is_laid_out(config, pool_paths):
+        print("fio work file pool already laid out")
+        return
+
+    print("laying out fio work file pool")
+    for p in pool_paths:
+        for f in [_workfile_pool_marker_path(p), p]:
+            if f.exists():
+                f.unlink()
+    must_run([
+        config["fio_binary"],
+        "--name", "layout_workfile_pool",
+        "--ioengine=sync",
+        "--rw=write",
+        f"--blocksize={config['blocksize']}",
+        f"--size={pool['file_size']}",
+        f"--numjobs={pool['nfiles']}",
+        f"--filename_format={filename_format.format('$jobnum')}",
+        "--create_only=1",
+    ])
+    os.sync()
+    marker = json.dumps(_workfile_pool_marker(config))
+    for p in pool_paths:
+        _workfile_pool_marker_path(p).write_text(marker)
+    os.sync()
+    assert _workfile_pool_is_laid_out(config, pool_paths)
+
+def _prewrite_workfiles(config, filename_format):
+    """fill all job files with random data: one fio job per file, running concurrently, followed by a single sync
+
+    refill_buffers makes fio generate fresh data for every write with its fast PRNG, so the data doesn't
+    compress or dedup, without the cost of reading /dev/urandom.
+    """
+    print("prewriting fio work files")
+    must_run([
+        config["fio_binary"],
+        "--name", "prewrite_workfiles",
+        "--ioengine=sync",
+        "--rw=write",
+        f"--blocksize={config['blocksize']}",
+        f"--size={config['size']}",
+        f"--numjobs={config['numjobs']}",
+        f"--filename_format={filename_format.format('$jobnum')}",
+        "--refill_buffers=1",
+        "--end_fsync=0",
+    ])
+    os.sync()
+    for i in range(0, config['numjobs']):
+        workfile_path = Path(filename_format.format(i))
+        assert workfile_path.stat().st_size == config['size']
+
 def _syncwrite_benchmark_fs(config, **kwargs):
 
     filename_format = config['target']['filename_format_str']
@@ -140,27 +448,25 @@ def _syncwrite_benchmark_fs(config, **kwargs):
         if workfile_path.exists() and not workfile_path.is_file():
             raise Exception(f"filename_format_str expanded to workfile_path={workfile_path} must be a file or not exist")
 
+        if config['target']['prewrite_mode'] == "reuse":
+            continue
+
         if workfile_path.exists():
             workfile_path.unlink()
         assert not workfile_path.exists()
 
-        if config['target']['prewrite_mode'] == "prewrite":
-            subprocess.run([
-                "dd",
-                "if=/dev/urandom", f"of={workfile_path}",
-                f"bs={config['blocksize']}",
-                f"count={config['size'] >> math.log2(config['blocksize'])}",
-                "conv=fsync",
-            ], check=True)
-            assert workfile_path.exists()
-            assert workfile_path.stat().st_size == config['size']
-        else:
-            assert config['target']['prewrite_mode'] == "delete"
+        assert config['target']['prewrite_mode'] in ["delete", "prewrite"]
+
+    if config['target']['prewrite_mode'] == "prewrite":
+        _prewrite_workfiles(config, filename_format)
+    elif config['target']['prewrite_mode'] == "reuse":
+        _reuse_workfile_pool(config, filename_format)
 
     return _run_fio(
             config,
             {"ioengine": "sync", "direct": 0},
             [ f"--filename_format=" + filename_format.format("$jobnum") ],
+            create_files=config['target']['prewrite_mode'] != "reuse",
             **kwargs,
             )
 
@@ -189,6 +495,10 @@ def run(config, **kwargs):
     # validate once on entry, then add values to it
     config = FioBenchmarkConfig.validate(config)
 
+    target = config['target']
+    if target['type'] == "fs" and target['prewrite_mode'] == "reuse" and target['reuse_pool'] is None:
+        target['reuse_pool'] = {"nfiles": config['numjobs'], "file_size": config['size']}
+
     bytarget = {
         "blockdev": _syncwrite_benchmark_blockdev,
         "fs": _syncwrite_benchmark_fs,
@@ -0,0 +1,274 @@
+import numpy as np
+
+# fio's latency histogram bucket layout (stat.h / stat.c)
+#
+# The bins of json+ output are keyed by plat_idx_to_val(idx) (in ns), i.e., the bucket midpoint.
+# Buckets are log-linear: groups of PLAT_VAL buckets, each group doubling the bucket width.
+PLAT_BITS = 6
+PLAT_VAL = 1 << PLAT_BITS
+PLAT_GROUP_NR = 29
+PLAT_NR = PLAT_GROUP_NR * PLAT_VAL
+
+def plat_idx_to_val(idx):
+    """vectorised plat_idx_to_val() from fio stat.c"""
+    idx = np.asarray(idx, dtype=np.int64)
+    if np.any((idx < 0) | (idx >= PLAT_NR)):
+        raise Exception(f"bucket index out of range [0, {PLAT_NR})")
+    error_bits = np.maximum((idx >> PLAT_BITS) - 1, 0)
+    base = np.left_shift(1, error_bits + PLAT_BITS, dtype=np.int64)
+    k = idx % PLAT_VAL
+    val = base + ((k + 0.5) * np.left_shift(1, error_bits, dtype=np.int64)).astype(np.int64)
+    return np.where(idx < (PLAT_VAL << 1), idx, val).astype(np.uint64)
+
+def plat_val_to_idx(val):
+    """vectorised plat_val_to_idx() from fio stat.c"""
+    val = np.asarray(val, dtype=np.uint64)
+    # msb via frexp is exact for the integer range fio produces (< 2**53)
+    msb = np.frexp(val.astype(np.float64))[1].astype(np.int64) - 1
+    msb = np.maximum(msb, 0)
+    error_bits = np.maximum(msb - PLAT_BITS, 0)
+    base = (error_bits + 1) << PLAT_BITS
+    offset = (PLAT_VAL - 1) & (val.astype(np.int64) >> error_bits)
+    idx = np.minimum(base + offset, PLAT_NR - 1)
+    return np.where(msb <= PLAT_BITS, val.astype(np.int64), idx)
+
+# midpoint (ns) of every bucket
+PLAT_BUCKET_NS = plat_idx_to_val(np.arange(PLAT_NR))
+
+# column name => path within jobs[0][ddir]
+DEFAULT_SCALAR_FIELDS = {
+    "iops": "iops",
+    "iops_mean": "iops_mean",
+    "iops_stddev": "iops_stddev",
+    "bw_bytes": "bw_bytes",
+    "total_ios": "total_ios",
+    "runtime_ms": "runtime",
+    "lat_ns_mean": "lat_ns.mean",
+    "lat_ns_stddev": "lat_ns.stddev",
+    "lat_ns_min": "lat_ns.min",
+    "lat_ns_max": "lat_ns.max",
+    "clat_ns_mean": "clat_ns.mean",
+    "clat_ns_stddev": "clat_ns.stddev",
+    "clat_ns_N": "clat_ns.N",
+}
+
+def _get_path(d, path):
+    for k in path.split("."):
+        d = d[k]
+    return d
+
+def _group_reporting_job(jsonplus):
+    jobs = jsonplus["jobs"]
+    if len(jobs) != 1:
+        raise Exception(f"expecting exactly one job (group_reporting=1), got {len(jobs)}")
+    return jobs[0]
+
+def clat_bins_to_dense(bins):
+    """json+ clat_ns.bins ({"<bucket ns>": count}) => (PLAT_NR,) uint64 counts"""
+    dense = np.zeros(PLAT_NR, dtype=np.uint64)
+    if len(bins) == 0:
+        return dense
+    vals = np.fromiter((int(k) for k in bins.keys()), dtype=np.uint64, count=len(bins))
+    counts = np.fromiter(bins.values(), dtype=np.uint64, count=len(bins))
+    idx = plat_val_to_idx(vals)
+    if not np.array_equal(PLAT_BUCKET_NS[idx], vals):
+        raise Exception("clat_ns.bins keys are not fio bucket values, was fio built with different FIO_IO_U_PLAT_BITS?")
+    np.add.at(dense, idx, counts)
+    return dense
+
+class JsonplusArrays:
+    """columnar view of a batch of fio json+ outputs
+
+    scalars:    name => (n,) float64 array, NaN where a run lacks the field
+    bucket_ns:  (b,) uint64 array, the shared bucket axis (midpoints in ns), trimmed to the buckets used by any run
+    clat_bins:  (n, b) uint64 array of clat_ns.bins counts
+    """
+
+    def __init__(self, scalars, bucket_ns, clat_bins):
+        self.scalars = scalars
+        self.bucket_ns = bucket_ns
+        self.clat_bins = clat_bins
+
+    def __len__(self):
+        return self.clat_bins.shape[0]
+
+def extract(jsonplus_outputs, ddir="write", scalar_fields=DEFAULT_SCALAR_FIELDS):
+    """extract scalar metrics and clat histograms from fio json+ outputs (group_reporting=1) in one pass"""
+    jsonplus_outputs = list(jsonplus_outputs)
+    n = len(jsonplus_outputs)
+    scalars = {name: np.full(n, np.nan) for name in scalar_fields}
+    dense = np.zeros((n, PLAT_NR), dtype=np.uint64)
+    for i, jsonplus in enumerate(jsonplus_outputs):
+        d = _group_reporting_job(jsonplus)[ddir]
+        for name, path in scalar_fields.items():
+            try:
+                scalars[name][i] = _get_path(d, path)
+            except KeyError:
+                pass
+        dense[i] = clat_bins_to_dense(d["clat_ns"].get("bins", {}))
+
+    used = np.flatnonzero(dense.any(axis=0))
+    lo, hi = (used[0], used[-1] + 1) if len(used) else (0, 0)
+    return JsonplusArrays(scalars, PLAT_BUCKET_NS[lo:hi], dense[:, lo:hi])
+
+class LatencyHistogram:
+    """array-backed latency histogram on fio's log-linear bucket layout
+
+    Only the range between the lowest and highest non-empty bucket is stored.
+    merge / subtraction are O(buckets), percentile lookup uses the same convention as fio's json+ output.
+    """
+
+    def __init__(self, offset=0, counts=None):
+        counts = np.zeros(0, dtype=np.uint64) if counts is None else np.asarray(counts, dtype=np.uint64)
+        if offset < 0 or offset + len(counts) > PLAT_NR:
+            raise Exception(f"buckets [{offset}, {offset + len(counts)}) out of range [0, {PLAT_NR})")
+        # trim so that equal histograms have equal representations
+        nz = np.flatnonzero(counts)
+        if len(nz) == 0:
+            offset, counts = 0, counts[:0]
+        else:
+            offset, counts = offset + nz[0], counts[nz[0]:nz[-1] + 1]
+        self.offset = int(offset)
+        self.counts = counts
+
+    @classmethod
+    def from_jsonplus_bins(cls, bins):
+        return cls.from_dense(clat_bins_to_dense(bins))
+
+    @classmethod
+    def from_jsonplus(cls, jsonplus, ddir="write"):
+        """clat histogram of a fio json+ output (group_reporting=1)"""
+        return cls.from_jsonplus_bins(_group_reporting_job(jsonplus)[ddir]["clat_ns"].get("bins", {}))
+
+    @classmethod
+    def from_dense(cls, dense):
+        """from (PLAT_NR,) counts, see clat_bins_to_dense"""
+        return cls(0, dense)
+
+    @classmethod
+    def from_dict(cls, d):
+        dense = np.zeros(PLAT_NR, dtype=np.uint64)
+        np.add.at(dense, np.asarray(d["idx"], dtype=np.int64), np.asarray(d["counts"], dtype=np.uint64))
+        return cls.from_dense(dense)
+
+    def to_dict(self):
+        """compact (sparse) encoding for result dicts"""
+        nz = np.flatnonzero(self.counts)
+        return {
+            "idx": (nz + self.offset).tolist(),
+            "counts": self.counts[nz].tolist(),
+        }
+
+    def _widen(self, lo, hi):
+        a = np.zeros(hi - lo, dtype=np.uint64)
+        if len(self.counts):
+            a[self.offset - lo:self.offset - lo + len(self.counts)] = self.counts
+        return a
+
+    @staticmethod
+    def _range(histograms):
+        nonempty = [h for h in histograms if len(h.counts)]
+        lo = min((h.offset for h in nonempty), default=0)
+        hi = max((h.offset + len(h.counts) for h in nonempty), default=0)
+        return lo, hi
+
+    def _aligned(self, other):
+        lo, hi = self._range([self, other])
+        return lo, self._widen(lo, hi), other._widen(lo, hi)
+
+    def __add__(self, other):
+        lo, a, b = self._aligned(other)
+        return LatencyHistogram(lo, a + b)
+
+    def __sub__(self, other):
+        lo, a, b = self._aligned(other)
+        if np.any(b > a):
+            raise Exception("cannot subtract a histogram that is not contained in this one")
+        return LatencyHistogram(lo, a - b)
+
+    def __eq__(self, other):
+        return isinstance(other, LatencyHistogram) and self.offset == other.offset and np.array_equal(self.counts, other.counts)
+
+    @staticmethod
+    def merge(histograms):
+        histograms = list(histograms)
+        lo, hi = LatencyHistogram._range(histograms)
+        acc = np.zeros(hi - lo, dtype=np.uint64)
+        for h in histograms:
+            if len(h.counts):
+                acc[h.offset - lo:h.offset - lo + len(h.counts)] += h.counts
+        return LatencyHistogram(lo, acc)
+
+    @property
+    def total(self):
+        return int(self.counts.sum())
+
+    @property
+    def bucket_ns(self):
+        return PLAT_BUCKET_NS[self.offset:self.offset + len(self.counts)]
+
+    def percentile(self, q):
+        """latency (ns, bucket value) below which q percent of the samples are; q may be an array"""
+        q = np.asarray(q, dtype=np.float64)
+        if np.any((q < 0) | (q > 100)):
+            raise Exception("percentile must be in [0, 100]")
+        if self.total == 0:
+            raise Exception("empty histogram")
+        cum = np.cumsum(self.counts)
+        # fio: first bucket where the cumulative count reaches q% of the samples
+        i = np.searchsorted(cum, np.maximum(q / 100.0 * cum[-1], 1), side="left")
+        return self.bucket_ns[np.minimum(i, len(cum) - 1)]
+
+    def mean(self):
+        if self.total == 0:
+            raise Exception("empty histogram")
+        return float(np.dot(self.bucket_ns.astype(np.float64), self.counts) / self.total)
+
+    def __repr__(self):
+        return f"LatencyHistogram(total={self.total}, buckets=[{self.offset}, {self.offset + len(self.counts)}))"
+
+def _test_plat():
+    idx = np.arange(PLAT_NR)
+    vals = plat_idx_to_val(idx)
+    assert np.all(np.diff(vals.astype(np.int64)) > 0)
+    assert np.array_equal(plat_val_to_idx(vals), idx)
+    # spot checks against fio
+    assert plat_idx_to_val(510) == 8096
+    assert plat_val_to_idx(8097) == 510
+    assert plat_val_to_idx(0) == 0 and plat_val_to_idx(127) == 127
+    assert plat_val_to_idx(2**62) == PLAT_NR - 1
+
+def _test_extract():
+    def job(iops, bins):
+        return {"jobs": [{"write": {"iops": iops, "lat_ns": {"mean": 1.5}, "clat_ns": {"bins": bins}}}]}
+    a = extract([job(10, {"8096": 1, "8384": 5}), job(20, {"8384": 2, "100": 7})])
+    assert list(a.scalars["iops"]) == [10, 20]
+    assert list(a.scalars["lat_ns_mean"]) == [1.5, 1.5]
+    assert np.isnan(a.scalars["iops_mean"]).all()
+    assert a.bucket_ns[0] == 100 and a.bucket_ns[-1] == 8384
+    assert a.clat_bins.sum(axis=1).tolist() == [6, 9]
+    assert a.clat_bins[:, -1].tolist() == [5, 2]
+    assert len(extract([])) == 0
+
+def _test_latency_histogram():
+    a = LatencyHistogram.from_jsonplus_bins({"8096": 1, "8384": 5})
+    b = LatencyHistogram.from_jsonplus_bins({"100": 7, "8384": 2})
+    ab = a + b
+    assert ab.total == 15
+    assert ab == LatencyHistogram.merge([a, b]) == LatencyHistogram.merge([b, LatencyHistogram(), a])
+    assert ab - b == a and ab - a == b
+    assert (ab - ab).total == 0 and ab - ab == LatencyHistogram()
+    try:
+        a - b
+        assert False
+    except Exception as e:
+        assert "subtract" in str(e)
+    assert LatencyHistogram.from_dict(ab.to_dict()) == ab
+    assert ab.percentile(0) == 100
+    assert ab.percentile(50) == 8096
+    assert list(ab.percentile([46, 47, 100])) == [100, 8096, 8384]
+    assert b.mean() == (7 * 100 + 2 * 8384) / 9
+
+_test_plat()
+_test_extract()
+_test_latency_histogram()
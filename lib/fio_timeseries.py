@@ -0,0 +1,207 @@
+from pathlib import Path
+import concurrent.futures
+import threading
+
+# fio ddir values in log files
+DDIR_READ = 0
+DDIR_WRITE = 1
+DDIR_TRIM = 2
+
+# log type => how samples of concurrent jobs in the same time bin are combined
+LOG_TYPES = {
+    "bw": "rate",   # KiB/s
+    "iops": "rate",
+    "lat": "mean",  # ns
+}
+
+def tail_lines(path: Path, stop: threading.Event, poll_interval=0.2, read_size=1<<16):
+    """yield complete lines appended to `path` until `stop` is set, then drain the rest of the file
+
+    The file need not exist yet. Only one read buffer is held in memory.
+    """
+    f = None
+    buf = ""
+    try:
+        while True:
+            stopped = stop.is_set() # check before reading so that we drain everything written before stop
+            chunk = ""
+            if f is None and path.exists():
+                f = open(path, "r")
+            if f is not None:
+                chunk = f.read(read_size)
+                if chunk:
+                    buf += chunk
+                    *lines, buf = buf.split("\n")
+                    yield from lines
+                    continue
+            if stopped:
+                break
+            stop.wait(poll_interval)
+        if buf:
+            yield buf
+    finally:
+        if f is not None:
+            f.close()
+
+def parse_log_line(line):
+    """fio log line => (time_ms, value, ddir), see 'Log File Formats' in the fio docs"""
+    fields = line.split(",")
+    return int(fields[0]), int(fields[1]), int(fields[2])
+
+class Downsampler:
+    """fixed-memory time series: bins of `width_ms`, doubling the width whenever there are more than max_points bins
+
+    mode "rate": samples are per-job rates over `base_width_ms`; a bin's value is the aggregate rate of all jobs.
+    mode "mean": a bin's value is the mean of its samples; min and max are kept as well.
+    """
+
+    def __init__(self, base_width_ms, max_points, mode):
+        assert mode in ("rate", "mean")
+        assert max_points >= 2
+        self.base_width_ms = base_width_ms
+        self.width_ms = base_width_ms
+        self.max_points = max_points
+        self.mode = mode
+        self.bins = {} # bin index => [sum, n, min, max]
+        self.nsamples = 0
+
+    def add(self, t_ms, value):
+        self.nsamples += 1
+        i = t_ms // self.width_ms
+        b = self.bins.get(i)
+        if b is None:
+            self.bins[i] = [value, 1, value, value]
+            if len(self.bins) > self.max_points:
+                self._coarsen()
+        else:
+            b[0] += value
+            b[1] += 1
+            b[2] = min(b[2], value)
+            b[3] = max(b[3], value)
+
+    def _coarsen(self):
+        while len(self.bins) > self.max_points:
+            self.width_ms *= 2
+            bins = {}
+            for i, (s, n, lo, hi) in self.bins.items():
+                j = i // 2
+                b = bins.get(j)
+                if b is None:
+                    bins[j] = [s, n, lo, hi]
+                else:
+                    b[0] += s
+                    b[1] += n
+                    b[2] = min(b[2], lo)
+                    b[3] = max(b[3], hi)
+            self.bins = bins
+
+    def to_dict(self):
+        idx = sorted(self.bins)
+        d = {
+            "width_ms": self.width_ms,
+            "nsamples": self.nsamples,
+            "t_ms": [i * self.width_ms for i in idx],
+        }
+        if self.mode == "rate":
+            intervals = self.width_ms / self.base_width_ms
+            d["value"] = [self.bins[i][0] / intervals for i in idx]
+        else:
+            d["value"] = [self.bins[i][0] / self.bins[i][1] for i in idx]
+            d["min"] = [self.bins[i][2] for i in idx]
+            d["max"] = [self.bins[i][3] for i in idx]
+        return d
+
+def log_file_path(dir: Path, prefix, log_type):
+    # with per_job_logs=0, all jobs share one file
+    return dir / f"{prefix}_{log_type}.log"
+
+def fio_log_args(prefix, log_avg_msec):
+    return [
+        f"--write_bw_log={prefix}",
+        f"--write_iops_log={prefix}",
+        f"--write_lat_log={prefix}",
+        f"--log_avg_msec={log_avg_msec}",
+        "--per_job_logs=0",
+    ]
+
+class LogCollector:
+    """tails fio's bw / iops / lat logs in `dir` into Downsamplers while fio runs
+
+    Note that fio keeps log entries in memory and usually writes them out only when a job exits.
+    Either way, memory use on our side is bounded by max_points per log.
+    """
+
+    def __init__(self, dir: Path, prefix, log_avg_msec, max_points, ddir=DDIR_WRITE):
+        self.dir = dir
+        self.prefix = prefix
+        self.ddir = ddir
+        self.samplers = {t: Downsampler(log_avg_msec, max_points, mode) for t, mode in LOG_TYPES.items()}
+        self._stop = threading.Event()
+        self._executor = None
+        self._futures = []
+
+    def _collect(self, log_type):
+        sampler = self.samplers[log_type]
+        for line in tail_lines(log_file_path(self.dir, self.prefix, log_type), self._stop):
+            if not line.strip():
+                continue
+            t_ms, value, ddir = parse_log_line(line)
+            if ddir == self.ddir:
+                sampler.add(t_ms, value)
+
+    def start(self):
+        assert self._executor is None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.samplers))
+        self._futures = [self._executor.submit(self._collect, t) for t in self.samplers]
+
+    def stop(self):
+        """call after fio exited, drains the logs"""
+        self._stop.set()
+        try:
+            for f in self._futures:
+                f.result()
+        finally:
+            self._executor.shutdown()
+
+    def to_dict(self):
+        return {t: s.to_dict() for t, s in self.samplers.items()}
+
+def _test_downsampler():
+    # two jobs, 10ms samples, 1000 IOPS each
+    d = Downsampler(10, 4, "rate")
+    for t in range(0, 100, 10):
+        d.add(t, 1000)
+        d.add(t + 1, 1000)
+    r = d.to_dict()
+    assert len(r["t_ms"]) <= 4
+    assert r["width_ms"] == 40
+    assert r["t_ms"] == [0, 40, 80]
+    assert r["value"][:2] == [2000, 2000]
+    assert r["nsamples"] == 20
+
+    d = Downsampler(10, 3, "mean")
+    for t, v in [(0, 1), (5, 3), (10, 5), (20, 7), (30, 9)]:
+        d.add(t, v)
+    r = d.to_dict()
+    assert r["width_ms"] == 20
+    assert r["value"] == [3, 8]
+    assert r["min"] == [1, 7] and r["max"] == [5, 9]
+
+def _test_tail_lines():
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        p = Path(d) / "x.log"
+        stop = threading.Event()
+        lines = []
+        t = threading.Thread(target=lambda: lines.extend(tail_lines(p, stop, poll_interval=0.01, read_size=3)))
+        t.start()
+        with open(p, "w") as f:
+            f.write("1, 2, 1, 4096, 0\n3, 4")
+            f.flush()
+            f.write(", 1, 4096, 0\n")
+        stop.set()
+        t.join()
+        assert [parse_log_line(l) for l in lines] == [(1, 2, 1), (3, 4, 1)]
+
+_test_downsampler()
+_test_tail_lines()
@@ -1,4 +1,6 @@
 import mergedict
+import schema
+import collections.abc
 import subprocess
 import copy
 import time
@@ -7,6 +9,13 @@ import os
 import functools
 import json
 import itertools
+import ctypes
+import ctypes.util
+import select
+import errno
+import collections
+import re
+import threading
 
 def must_run(*args, **kwargs):
     print(f"running command {args[0]}")
@@ -23,6 +32,127 @@ def must_run(*args, **kwargs):
         print(f"{e}\nstdout:\n{e.stdout}\nstderr:\n{e.stderr}")
         raise e
 
+def iter_output_lines(pipe, sep=rb"\n"):
+    """yield the lines of binary `pipe` as they arrive, decoded, each including its separator (regex `sep`)
+
+    Reads whatever is available instead of waiting for full buffers, so lines arrive while the process runs.
+    """
+    sep = re.compile(sep)
+    buf = b""
+    while True:
+        chunk = pipe.read1(1<<16)
+        if not chunk:
+            break
+        buf += chunk
+        start = 0
+        for m in sep.finditer(buf):
+            yield buf[start:m.end()].decode("utf-8", errors="replace")
+            start = m.end()
+        buf = buf[start:]
+    if buf:
+        yield buf.decode("utf-8", errors="replace")
+
+class StreamingProcess:
+    """run `args` with its output streamed line by line instead of buffered until exit
+
+        with StreamingProcess(args) as p:
+            for line in p:
+                ...  # parse while the process runs, p.send_signal() etc.
+        # left the context => process exited, CalledProcessError if check and nonzero exit status
+
+    stdout (with stderr if merge_stderr) is iterated over, each line is also passed to `sink` (without separator).
+    Lines the caller doesn't consume are drained on exit. Only the last `tail_lines` lines are kept, for error reports.
+    With merge_stderr=False, stderr goes to `sink` and its own tail from a background thread.
+    """
+
+    def __init__(self, args, sink=print, tail_lines=100, merge_stderr=True, sep=rb"\n", check=True, **popen_kwargs):
+        self.args = args
+        self.sink = sink or (lambda line: None)
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.stderr_tail = collections.deque(maxlen=tail_lines)
+        self.merge_stderr = merge_stderr
+        self.sep = sep
+        self.check = check
+        self.popen_kwargs = popen_kwargs
+        self.process = None
+        self._lines = None
+        self._stderr_thread = None
+
+    def _stream(self, pipe, tail):
+        for line in iter_output_lines(pipe, self.sep):
+            tail.append(line)
+            self.sink(line.rstrip("\r\n"))
+            yield line
+
+    def _drain_stderr(self):
+        for _ in self._stream(self.process.stderr, self.stderr_tail):
+            pass
+
+    def __enter__(self):
+        stderr = subprocess.STDOUT if self.merge_stderr else subprocess.PIPE
+        self.process = subprocess.Popen(self.args, stdout=subprocess.PIPE, stderr=stderr, **self.popen_kwargs)
+        self._lines = self._stream(self.process.stdout, self.tail)
+        if not self.merge_stderr:
+            self._stderr_thread = threading.Thread(target=self._drain_stderr, daemon=True)
+            self._stderr_thread.start()
+        return self
+
+    def __iter__(self):
+        return self._lines
+
+    def send_signal(self, sig):
+        self.process.send_signal(sig)
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    @property
+    def output_tail(self):
+        return "".join(self.tail)
+
+    @property
+    def stderr_tail_str(self):
+        return "".join(self.stderr_tail)
+
+    def wait(self):
+        for _ in self._lines:
+            pass
+        returncode = self.process.wait()
+        if self._stderr_thread:
+            self._stderr_thread.join()
+        if self.check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.args, output=self.output_tail, stderr=self.stderr_tail_str or None)
+        return returncode
+
+    def __exit__(self, type, val, bt):
+        try:
+            if type is not None:
+                self.process.kill()
+            self.wait()
+        finally:
+            self.process.__exit__(type, val, bt)
+
+def _test_streaming_process():
+    import sys
+    sunk = []
+    script = "import sys\nfor i in range(5): print(i, flush=True)\nprint('err', file=sys.stderr)\nprint('x', end='')\nsys.exit(3)"
+    try:
+        with StreamingProcess([sys.executable, "-c", script], sink=sunk.append, tail_lines=3) as p:
+            first = next(iter(p))
+        assert False
+    except subprocess.CalledProcessError as e:
+        assert e.returncode == 3
+        assert e.output == "4\nerr\nx"
+        assert first == "0\n"
+        assert len(sunk) == 7 and sunk[-1] == "x"
+
+    with StreamingProcess([sys.executable, "-c", script], sink=None, merge_stderr=False, check=False) as p:
+        lines = list(p)
+    assert "".join(lines) == "0\n1\n2\n3\n4\nx"
+    assert p.returncode == 3 and p.stderr_tail_str == "err\n"
+_test_streaming_process()
+
 def assert_allowed_keys(dic, must_subset):
     ok = set(dic.keys()).issubset(set(must_subset))
     if ok:
@@ -39,12 +169,121 @@ def string_with_one_format_placeholder(s):
 
 import deepmerge
 
-def merge_dicts(d, updates):
-    deepmerge.always_merger(d, updates)
+class FrozenDict(collections.abc.Mapping):
+    """immutable dict for configs, built with freeze()
+
+    merge() copies only the dicts along the paths that change and shares everything else,
+    so deriving many configs from a common base costs O(size of the update), not O(size of the config).
+    """
+    __slots__ = ("_d",)
+
+    def __init__(self, d=()):
+        self._d = {k: freeze(v) for k, v in dict(d).items()}
+
+    @classmethod
+    def _wrap(cls, d):
+        # d's values are frozen already
+        f = cls.__new__(cls)
+        f._d = d
+        return f
+
+    def __getitem__(self, k):
+        return self._d[k]
+
+    def __iter__(self):
+        return iter(self._d)
+
+    def __len__(self):
+        return len(self._d)
+
+    def __repr__(self):
+        return f"FrozenDict({self._d!r})"
+
+    def merge(self, updates):
+        """merge_dicts() semantics, returns a new FrozenDict"""
+        return _merge_frozen(self, freeze(updates))
+
+    def thaw(self):
+        return thaw(self)
+
+class _FrozenList(tuple):
+    pass
+
+class _FrozenSet(frozenset):
+    pass
+
+def freeze(v):
+    """dicts / lists / sets => FrozenDict / tuple / frozenset, recursively; FrozenDicts are shared, not copied"""
+    if isinstance(v, (FrozenDict, _FrozenList, _FrozenSet)):
+        return v
+    if isinstance(v, dict):
+        return FrozenDict._wrap({k: freeze(x) for k, x in v.items()})
+    if isinstance(v, list):
+        return _FrozenList(freeze(x) for x in v)
+    if isinstance(v, set):
+        return _FrozenSet(freeze(x) for x in v)
+    return v
+
+def thaw(v):
+    """inverse of freeze(), returns new plain dicts / lists / sets"""
+    if isinstance(v, FrozenDict):
+        return {k: thaw(x) for k, x in v._d.items()}
+    if isinstance(v, _FrozenList):
+        return [thaw(x) for x in v]
+    if isinstance(v, _FrozenSet):
+        return {thaw(x) for x in v}
+    return v
+
+def _merge_frozen(base, nxt):
+    if isinstance(base, FrozenDict) and isinstance(nxt, FrozenDict):
+        d = dict(base._d)
+        for k, v in nxt._d.items():
+            d[k] = _merge_frozen(d[k], v) if k in d else v
+        return FrozenDict._wrap(d)
+    if isinstance(base, _FrozenList) and isinstance(nxt, _FrozenList):
+        return _FrozenList(base + nxt)
+    if isinstance(base, _FrozenSet) and isinstance(nxt, _FrozenSet):
+        return _FrozenSet(base | nxt)
+    return nxt
+
+def _copy_containers(v):
+    # what copy.deepcopy did for the configs we merge, without its memo / dispatch overhead
+    if isinstance(v, dict):
+        return {k: _copy_containers(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return [_copy_containers(x) for x in v]
+    if isinstance(v, set):
+        return set(v)
+    return v
+
+def _merge_into(base: dict, nxt):
+    for k, v in nxt.items():
+        if k not in base:
+            base[k] = v
+            continue
+        b = base[k]
+        if isinstance(b, dict) and isinstance(v, dict):
+            _merge_into(b, v)
+        elif isinstance(b, list) and isinstance(v, list):
+            base[k] = b + v
+        elif isinstance(b, set) and isinstance(v, set):
+            base[k] = b | v
+        else:
+            base[k] = v
 
 def merge_dicts(d, updates):
-    d = copy.deepcopy(d)
-    deepmerge.always_merger.merge(d, updates)
+    """deep merge `updates` into a copy of `d`: dicts are merged recursively, lists appended, sets unioned,
+    otherwise `updates` wins (deepmerge's always_merger). Neither argument is modified.
+
+    Like always_merger, the result shares values of `updates` that aren't merged with a value of `d`.
+    Accepts FrozenDicts, returns plain dicts.
+    """
+    if isinstance(d, FrozenDict):
+        d = thaw(d)
+    if isinstance(updates, FrozenDict):
+        updates = thaw(updates)
+    d = _copy_containers(d)
+    _merge_into(d, updates)
     return d
 
 def _merge_dicts_tests():
@@ -76,8 +315,113 @@ def _merge_dicts_tests():
     assert res["shared"]["shared"]["b"] == "bar"
     assert res["shared"]["shared"]["shared"] == "b"
 
+
+    # same results as deepmerge (which merge_dicts used to be)
+    a = {"l": [1, {"x": 1}], "s": {1}, "d": {"t": (1, 2), "o": "x", "n": {"m": 1}}, "c": {"x": 1}}
+    b = {"l": [2], "s": {2}, "d": {"t": (3,), "o": {"now": "dict"}, "n": {"k": [1]}}, "c": 5, "new": {"y": 2}}
+    expect = deepmerge.always_merger.merge(copy.deepcopy(a), copy.deepcopy(b))
+    assert merge_dicts(a, b) == expect
+    a_orig = copy.deepcopy(a)
+    res = merge_dicts(a, b)
+    res["l"].append(3)
+    res["d"]["n"]["z"] = 1
+    assert a == a_orig
+
+    # FrozenDict: same semantics, structural sharing
+    fa = freeze(a)
+    fab = fa.merge(b)
+    assert thaw(fab) == expect and fab == freeze(expect)
+    assert fab["d"]["n"] is not fa["d"]["n"]
+    assert fab["l"][1] is fa["l"][1]
+    fac = fa.merge({"d": {"o": "y"}})
+    assert fac["c"] is fa["c"] and fac["d"]["n"] is fa["d"]["n"]
+    assert thaw(fa) == a
+    assert merge_dicts(fa, freeze(b)) == expect
+    try:
+        fa["x"] = 1
+        assert False
+    except TypeError:
+        pass
+
 _merge_dicts_tests()
 
+# value types that _content_key() accepts, compared by type and value
+_CONTENT_KEY_ATOMS = (str, int, float, bool, type(None), Path)
+
+def _content_key(v):
+    """hashable key equal for equal (dict / list / tuple / atom) data, TypeError for anything else"""
+    t = type(v)
+    if t is dict:
+        return (dict, tuple((_content_key(k), _content_key(x)) for k, x in v.items()))
+    if t is list or t is tuple:
+        return (t, tuple(_content_key(x) for x in v))
+    if isinstance(v, _CONTENT_KEY_ATOMS):
+        return (t, v)
+    raise TypeError(f"no content key for {t}")
+
+class CachedSchema:
+    """schema.Schema whose validate() remembers results by the content of the validated data
+
+    Validating the same config over and over (e.g. the same fio config on every storage stack)
+    then costs a hash of the data instead of a walk through the schema.
+    Only use it for schemas whose validation depends on nothing but the data
+    (no checks against the file system etc.). Data that contains other types than
+    dicts, lists, tuples, str, numbers, None and Paths is validated without the cache.
+    validate() returns a copy of the cached result, callers may modify it.
+    """
+
+    def __init__(self, schema, maxsize=128):
+        self.schema = schema
+        self.maxsize = maxsize
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def validate(self, data):
+        try:
+            key = _content_key(data)
+        except TypeError:
+            return self.schema.validate(data)
+        with self._lock:
+            hit = self._cache.get(key)
+            if hit is not None:
+                self._cache.move_to_end(key)
+        if hit is None:
+            hit = self.schema.validate(data) # raises for invalid data => never cached
+            with self._lock:
+                self._cache[key] = hit
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+        return _copy_containers(hit)
+
+    def is_valid(self, data):
+        try:
+            self.validate(data)
+            return True
+        except schema.SchemaError:
+            return False
+
+def _test_cached_schema():
+    calls = []
+    def count(v):
+        calls.append(v)
+        return True
+    s = CachedSchema(schema.Schema({"a": schema.And(int, count), schema.Optional("l", default=[]): [str]}))
+    v = s.validate({"a": 1})
+    assert v == {"a": 1, "l": []}
+    v["l"].append("modified")
+    assert s.validate({"a": 1}) == {"a": 1, "l": []}
+    assert len(calls) == 1
+    # True == 1, but must not hit the cached result for 1
+    assert not s.is_valid({"a": True})
+    assert not s.is_valid({"a": "x"})
+    assert not s.is_valid({"a": 1, "l": ("x",)})
+    assert s.validate({"a": 1, "l": ["x"]})["l"] == ["x"]
+    # uncacheable data still validates
+    s2 = CachedSchema(schema.Schema({"o": object}))
+    o = object()
+    assert s2.validate({"o": o})["o"] is o
+_test_cached_schema()
+
 def deep_copy_dict(d):
     return merge_dicts({}, d)
 
@@ -95,6 +439,125 @@ def poll_wait(sleeptime, check, what="<unspecified>", timeout=None):
             raise Exception(f"poll_wait timeout {timeout}s waiting for {what}")
     print(f"poll_wait done: {what}")
 
+# inotify(7)
+_IN_ATTRIB = 0x004
+_IN_MOVED_FROM = 0x040
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_MOVE_SELF = 0x800
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+_IN_DIR_EVENTS = _IN_ATTRIB | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF
+
+@functools.lru_cache(maxsize=None)
+def _libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+def _inotify_init():
+    """=> inotify fd, None if inotify is unavailable"""
+    try:
+        libc = _libc()
+    except (OSError, AttributeError):
+        return None
+    fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    return fd if fd >= 0 else None
+
+def _inotify_add_watch(fd, path: Path):
+    """=> False if `path` vanished in the meantime"""
+    wd = _libc().inotify_add_watch(fd, os.fsencode(path), _IN_DIR_EVENTS)
+    if wd < 0:
+        e = ctypes.get_errno()
+        if e in (errno.ENOENT, errno.ENOTDIR):
+            return False
+        raise OSError(e, os.strerror(e), str(path))
+    return True
+
+def _deepest_existing_dir(path: Path):
+    for p in path.parents:
+        if p.is_dir():
+            return p
+    return Path("/")
+
+def wait_for_path(path, present=True, what=None, timeout=None, recheck_interval=1.0):
+    """wait until `path` exists (present=True) or doesn't exist (present=False)
+
+    Wakes up on inotify events in the deepest existing parent directory (e.g. udev creating /dev/mapper/<name>),
+    so returns as soon as the path (dis)appears. Falls back to polling if inotify is unavailable.
+    Timeout semantics are those of poll_wait.
+    """
+    path = Path(path)
+    what = what or f"{path} to {'appear' if present else 'disappear'}"
+    check = lambda: path.exists() == present
+
+    fd = _inotify_init()
+    if fd is None:
+        return poll_wait(0.1, check, what, timeout)
+
+    start = time.monotonic()
+    waiting = False
+    try:
+        while True:
+            # watch before the check so that we don't miss an event in between
+            while not _inotify_add_watch(fd, _deepest_existing_dir(path)):
+                pass
+            if check():
+                break
+            wait = recheck_interval
+            if timeout:
+                remaining = timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise Exception(f"wait_for_path timeout {timeout}s waiting for {what}")
+                wait = min(wait, remaining)
+            if not waiting:
+                print(f"wait_for_path for: {what}")
+                waiting = True
+            r, _, _ = select.select([fd], [], [], wait)
+            if r:
+                try:
+                    while os.read(fd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+    finally:
+        os.close(fd)
+    print(f"wait_for_path done: {what}")
+
+def _test_wait_for_path():
+    import contextlib
+    import io
+    import tempfile
+    with tempfile.TemporaryDirectory() as d, contextlib.redirect_stdout(io.StringIO()):
+        p = Path(d) / "a" / "b"
+        def create():
+            p.parent.mkdir()
+            p.write_text("")
+        # recheck_interval is long enough that only inotify can explain an early return
+        t = threading.Timer(0.01, create)
+        t.start()
+        start = time.monotonic()
+        wait_for_path(p, timeout=5, recheck_interval=10)
+        assert time.monotonic() - start < 1
+        t.join()
+
+        t = threading.Timer(0.01, p.unlink)
+        t.start()
+        start = time.monotonic()
+        wait_for_path(p, present=False, timeout=5, recheck_interval=10)
+        assert time.monotonic() - start < 1
+        t.join()
+
+        try:
+            wait_for_path(p, timeout=0.02, recheck_interval=10)
+            assert False
+        except Exception as e:
+            assert "timeout" in str(e)
+_test_wait_for_path()
+
 def zero_out_first_sector(blockdev):
     assert Path(blockdev).is_block_device()
     assert "nvme0" not in str(blockdev)
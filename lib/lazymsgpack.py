@@ -0,0 +1,138 @@
+import collections.abc
+import io
+import msgpack
+
+# msgpack type bytes, see https://github.com/msgpack/msgpack/blob/master/spec.md
+def _is_map(b):
+    return 0x80 <= b <= 0x8f or b in (0xde, 0xdf)
+
+def _is_array(b):
+    return 0x90 <= b <= 0x9f or b in (0xdc, 0xdd)
+
+def _unpacker(buf, offset):
+    f = io.BytesIO(buf)
+    f.seek(offset)
+    # small read_size: we usually only look at a few bytes at offset
+    return msgpack.Unpacker(f, raw=False, strict_map_key=False, read_size=4096)
+
+def _lazy_value(buf, offset):
+    b = buf[offset]
+    if _is_map(b):
+        return LazyMap(buf, offset)
+    if _is_array(b):
+        return LazyList(buf, offset)
+    return _unpacker(buf, offset).unpack()
+
+class LazyMap(collections.abc.Mapping):
+    """read-only view of the msgpack map at `offset` in `buf` that decodes values on first access
+
+    Building the key => offset table skips over the values without constructing Python objects.
+    Nested maps and arrays are lazy as well.
+    """
+
+    def __init__(self, buf, offset=0):
+        self._buf = buf
+        self._offset = offset
+        self._offsets = None
+        self._values = {}
+
+    def _index(self):
+        if self._offsets is None:
+            u = _unpacker(self._buf, self._offset)
+            offsets = {}
+            for _ in range(u.read_map_header()):
+                k = u.unpack()
+                offsets[k] = self._offset + u.tell()
+                u.skip()
+            self._offsets = offsets
+        return self._offsets
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        v = _lazy_value(self._buf, self._index()[key])
+        self._values[key] = v
+        return v
+
+    def __iter__(self):
+        return iter(self._index())
+
+    def __len__(self):
+        return len(self._index())
+
+    def __repr__(self):
+        return f"LazyMap({list(self._index().keys())!r})"
+
+class LazyList(collections.abc.Sequence):
+    """read-only view of the msgpack array at `offset` in `buf`, see LazyMap"""
+
+    def __init__(self, buf, offset):
+        self._buf = buf
+        self._offset = offset
+        self._offsets = None
+        self._values = {}
+
+    def _index(self):
+        if self._offsets is None:
+            u = _unpacker(self._buf, self._offset)
+            offsets = []
+            for _ in range(u.read_array_header()):
+                offsets.append(self._offset + u.tell())
+                u.skip()
+            self._offsets = offsets
+        return self._offsets
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        offsets = self._index()
+        if i < 0:
+            i += len(offsets)
+        if not 0 <= i < len(offsets):
+            raise IndexError("LazyList index out of range")
+        try:
+            return self._values[i]
+        except KeyError:
+            pass
+        v = _lazy_value(self._buf, offsets[i])
+        self._values[i] = v
+        return v
+
+    def __len__(self):
+        return len(self._index())
+
+    def __repr__(self):
+        return f"LazyList(len={len(self)})"
+
+def materialize(v):
+    """plain dicts / lists for (possibly nested) LazyMap / LazyList values"""
+    if isinstance(v, LazyMap):
+        return {k: materialize(v[k]) for k in v}
+    if isinstance(v, LazyList):
+        return [materialize(x) for x in v]
+    return v
+
+def _test_lazy():
+    d = {"a": {"b": [1, {"c": "x"}, [2, 3]], "big": list(range(1000))}, "s": "str", "n": None, 1: 2}
+    buf = msgpack.packb(d, use_bin_type=True)
+    m = LazyMap(buf)
+    assert m["s"] == "str"
+    assert m["n"] is None
+    assert m[1] == 2
+    assert m["a"]["b"][1]["c"] == "x"
+    assert m["a"]["b"][-1][1] == 3
+    assert len(m["a"]["big"]) == 1000
+    assert m["a"]["big"][2:4] == [2, 3]
+    l = m["a"]["b"]
+    assert [materialize(x) for x in l[::-2]] == d["a"]["b"][::-2] and l[5:] == []
+    for i in (3, -4):
+        try:
+            l[i]
+            assert False, i
+        except IndexError:
+            pass
+    assert "a" in m and "z" not in m
+    assert materialize(m) == d
+_test_lazy()
@@ -0,0 +1,108 @@
+from .resultstorage import ResultStorage
+import hashlib
+import json
+import traceback
+import uuid
+
+def _canonical_default(o):
+    # e.g. the Store in a benchmark's kwargs
+    if hasattr(o, "to_dict"):
+        return o.to_dict()
+    return str(o)
+
+def benchmark_as_dict(bench):
+    return {
+        "class": type(bench).__name__,
+        # Dummy isn't a lib.benchmarks.Benchmark
+        "kwargs": bench._asdict() if hasattr(bench, "_asdict") else {},
+    }
+
+def cell_key(stack, bench, params=None):
+    """stable identifier of running `bench` on `stack` with `params`"""
+    d = {
+        "storage_stack": stack.as_dict(),
+        "benchmark": benchmark_as_dict(bench),
+        "params": params,
+    }
+    s = json.dumps(d, sort_keys=True, default=_canonical_default)
+    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+class MatrixRunner:
+    """runs the cells of storage stacks x benchmarks that didn't complete yet
+
+    The status of each cell execution is recorded in the result storage under `{prefix}__matrix`:
+    {"matrix_cell": <cell_key>, "matrix_attempt": <uuid>, "status": "ok" | "failed", ...}.
+    Results saved through the runner carry the same "matrix_cell" and "matrix_attempt";
+    they only reach the result storage once their cell completed, so a failed or interrupted
+    attempt leaves no partial results under `prefix` behind.
+    Stacks whose cells all completed are not set up at all.
+    """
+
+    def __init__(self, result_storage: ResultStorage, prefix):
+        self.result_storage = result_storage
+        self.prefix = prefix
+        self.status_prefix = f"{prefix}__matrix"
+
+    def completed_cells(self):
+        df = self.result_storage.to_frame(self.status_prefix, ["matrix_cell", "status"])
+        return set(df[df["status"] == "ok"]["matrix_cell"])
+
+    def _save_status(self, stack, bench, params, key, attempt, status, exception_str=None):
+        self.result_storage.save_json_result(self.status_prefix, {
+            "matrix_cell": key,
+            "matrix_attempt": attempt,
+            "status": status,
+            "storage_stack": stack.as_dict(),
+            "benchmark": benchmark_as_dict(bench),
+            "params": params,
+            "exception_str": exception_str,
+        })
+
+    def run(self, stacks, benchmarks, run_cell, params=None):
+        """for each stack that has missing cells: enter it, then call
+        run_cell(entered_stack, bench_i, bench, save_result) for each missing cell
+
+        save_result(result_dict) stages a result, the staged results are saved under `prefix`
+        after run_cell returned.
+        An exception raised by run_cell marks the cell as failed; the remaining cells are still run.
+        Raises at the end if any cell failed.
+        """
+        completed = self.completed_cells()
+        failed = []
+        for stack in stacks:
+            todo = []
+            for bench_i, bench in enumerate(benchmarks):
+                key = cell_key(stack, bench, params)
+                if key in completed:
+                    print(f"matrix: skipping completed cell {key[:12]} ({benchmark_as_dict(bench)['class']} on {stack.as_dict().get('identity', type(stack).__name__)})")
+                    continue
+                todo.append((bench_i, bench, key))
+            if not todo:
+                continue
+
+            with stack as entered_stack:
+                for bench_i, bench, key in todo:
+                    attempt = str(uuid.uuid4())
+                    staged = []
+                    def save_result(rd):
+                        staged.append({
+                            **rd,
+                            "matrix_cell": key,
+                            "matrix_attempt": attempt,
+                        })
+                    try:
+                        run_cell(entered_stack, bench_i, bench, save_result)
+                    except Exception as e:
+                        traceback.print_exc()
+                        self._save_status(stack, bench, params, key, attempt, "failed", str(e))
+                        failed.append(e)
+                        continue
+                    for rd in staged:
+                        self.result_storage.save_json_result(self.prefix, rd)
+                    self._save_status(stack, bench, params, key, attempt, "ok")
+                    completed.add(key)
+
+        if failed:
+            for e in failed:
+                print(e)
+            raise Exception(f"{len(failed)} matrix cells failed")
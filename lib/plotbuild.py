@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# Execute the thesis notebooks with papermill in parallel, skipping notebooks whose inputs didn't change.
+#
+# Inputs of a notebook are
+# - the notebook source,
+# - the files in lib/,
+# - the results (file names + content hashes from the ResultStorage index) of all result prefixes
+#   that appear as string literals in the notebook's code (all results if none does).
+#
+# Usage: python3 -m lib.plotbuild [--jobs N] [--force] NOTEBOOK...
+
+from lib.resultstorage import ResultStorage
+from .helpers import must_run
+from pathlib import Path
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import re
+
+LIBDIR = Path(__file__).parent
+
+def sha256_lib_files():
+    h = hashlib.sha256()
+    for p in sorted(LIBDIR.rglob("*")):
+        if not p.is_file() or "__pycache__" in p.parts:
+            continue
+        h.update(str(p.relative_to(LIBDIR)).encode("utf-8"))
+        h.update(hashlib.sha256(p.read_bytes()).digest())
+    return h.hexdigest()
+
+def notebook_code(nbpath):
+    nb = json.loads(nbpath.read_text())
+    return "\n".join("".join(c["source"]) for c in nb["cells"] if c["cell_type"] == "code")
+
+def referenced_prefixes(code, known_prefixes):
+    literals = set(re.findall(r"""["']([^"'\n]+)["']""", code))
+    return sorted(literals & known_prefixes)
+
+def notebook_inputs_sha256(nbpath, lib_sha256, index_entries):
+    known_prefixes = {e["prefix"] for e in index_entries.values() if e["prefix"]}
+    prefixes = referenced_prefixes(notebook_code(nbpath), known_prefixes)
+    if prefixes:
+        results = {name: e["sha256"] for name, e in index_entries.items() if e["prefix"] in prefixes}
+    else:
+        results = {name: e["sha256"] for name, e in index_entries.items()}
+    h = hashlib.sha256()
+    h.update(hashlib.sha256(nbpath.read_bytes()).digest())
+    h.update(lib_sha256.encode("utf-8"))
+    h.update(json.dumps(sorted(results.items())).encode("utf-8"))
+    return h.hexdigest(), prefixes
+
+class PlotBuild:
+    def __init__(self, notebooks, outdir, resultdir, jobs, force):
+        self.notebooks = notebooks
+        self.outdir = outdir
+        self.statedir = outdir / ".plotbuild"
+        self.resultdir = resultdir
+        self.jobs = jobs
+        self.force = force
+
+    def _stamp_path(self, nb):
+        return self.statedir / f"{nb.name}.stamp.json"
+
+    def _run_notebook(self, nb, inputs_sha256):
+        stamp = self._stamp_path(nb)
+        if stamp.exists():
+            stamp.unlink() # in case the notebook fails half-way
+        must_run(["papermill", nb, self.statedir / nb.name])
+        stamp.write_text(json.dumps({"inputs_sha256": inputs_sha256}))
+
+    def run(self):
+        self.outdir.mkdir(exist_ok=True)
+        self.statedir.mkdir(exist_ok=True)
+
+        # warm the shared result index once instead of letting each notebook rescan concurrently
+        index_entries = ResultStorage(self.resultdir).index.entries()
+        lib_sha256 = sha256_lib_files()
+
+        todo = []
+        for nb in self.notebooks:
+            inputs_sha256, prefixes = notebook_inputs_sha256(nb, lib_sha256, index_entries)
+            stamp = self._stamp_path(nb)
+            if not self.force and stamp.exists() and json.loads(stamp.read_text())["inputs_sha256"] == inputs_sha256:
+                print(f"{nb}: up to date")
+                continue
+            print(f"{nb}: needs rebuild (result prefixes: {prefixes or 'all'})")
+            todo.append((nb, inputs_sha256))
+
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {executor.submit(self._run_notebook, nb, h): nb for nb, h in todo}
+            for f in concurrent.futures.as_completed(futures):
+                nb = futures[f]
+                try:
+                    f.result()
+                    print(f"{nb}: done")
+                except Exception as e:
+                    print(f"{nb}: failed: {e}")
+                    failed.append(nb)
+
+        if failed:
+            raise Exception(f"notebooks failed: {failed}")
+
+def main():
+    parser = argparse.ArgumentParser(description="execute notebooks with papermill, in parallel and only if their inputs changed")
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--force", action="store_true", help="rebuild all notebooks")
+    parser.add_argument("--outdir", type=Path, default=Path("./postprocess_results"))
+    parser.add_argument("--resultdir", type=Path, default=Path("./results"))
+    parser.add_argument("notebooks", nargs="+", type=Path)
+    args = parser.parse_args()
+    PlotBuild(args.notebooks, args.outdir, args.resultdir, args.jobs, args.force).run()
+
+if __name__ == "__main__":
+    main()
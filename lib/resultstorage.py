@@ -1,8 +1,27 @@
 import functools
+import copy
 import json
 import dotted
-from lib.helpers import string_with_one_format_placeholder
+from lib.helpers import string_with_one_format_placeholder, json_dump_default_to_str
 import uuid
+import os
+import re
+import time
+import fcntl
+import hashlib
+import contextlib
+from pathlib import Path
+import collections
+import concurrent.futures
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import gzip
+import zstandard
+import msgpack
+import argparse
+import collections.abc
+from lib.lazymsgpack import LazyMap, materialize
 
 def find_unused_random_filename_in_dir(d, pattern):
     assert string_with_one_format_placeholder(pattern)
@@ -11,31 +30,625 @@ def find_unused_random_filename_in_dir(d, pattern):
         if not p.exists():
             return p
 
-class ResultStorage:
+def _msgpack_dumps(d):
+    return msgpack.packb(d, default=json_dump_default_to_str, use_bin_type=True)
+
+def _msgpack_loads(b):
+    return msgpack.unpackb(b, raw=False, strict_map_key=False)
+
+def _json_dumps(d):
+    return json.dumps(d, default=json_dump_default_to_str).encode("utf-8")
+
+# format name (= file name suffix without the leading dot) => (encode, decode)
+RESULT_FORMATS = {
+    "json": (_json_dumps, json.loads),
+    "json.gz": (lambda d: gzip.compress(_json_dumps(d), compresslevel=6), lambda b: json.loads(gzip.decompress(b))),
+    "json.zst": (lambda d: zstandard.ZstdCompressor().compress(_json_dumps(d)), lambda b: json.loads(zstandard.ZstdDecompressor().decompress(b))),
+    "msgpack": (_msgpack_dumps, _msgpack_loads),
+    "msgpack.zst": (lambda d: zstandard.ZstdCompressor().compress(_msgpack_dumps(d)), lambda b: _msgpack_loads(zstandard.ZstdDecompressor().decompress(b))),
+}
+
+def result_file_format(name):
+    """format of result file `name` according to its suffix, None if it's not a result file"""
+    # longest suffix first so that "json.zst" isn't mistaken for something ending in ".zst"
+    for fmt in sorted(RESULT_FORMATS.keys(), key=len, reverse=True):
+        if name.endswith("." + fmt):
+            return fmt
+    return None
+
+RESULT_FILENAME_RE = re.compile(r"^(?P<prefix>.+)-(?P<uuid>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\.(?P<format>[a-z.]+)$")
+
+def result_filename_prefix(name):
+    """prefix that save_json_result used for result file `name`, None if the name doesn't follow the scheme"""
+    m = RESULT_FILENAME_RE.match(name)
+    if not m or m["format"] not in RESULT_FORMATS:
+        return None
+    return m["prefix"]
+
+def _test_result_filename_prefix():
+    assert result_filename_prefix("app_benchmarks__v4-001e82cc-c1c4-40f1-9dc9-9816eb52d561.json") == "app_benchmarks__v4"
+    assert result_filename_prefix("app_benchmarks__v4-001e82cc-c1c4-40f1-9dc9-9816eb52d561.json.zst") == "app_benchmarks__v4"
+    assert result_filename_prefix("a-b-001e82cc-c1c4-40f1-9dc9-9816eb52d561.msgpack") == "a-b"
+    assert result_filename_prefix("a-b-001e82cc-c1c4-40f1-9dc9-9816eb52d561.txt") is None
+    assert result_filename_prefix("store-savepoint.json") is None
+_test_result_filename_prefix()
+
+def name_matches_prefix(name, prefix):
+    """same semantics as resultdir.glob(f"{prefix}-*.json"), for all result formats"""
+    fmt = result_file_format(name)
+    if fmt is None:
+        return False
+    return name[:-len(fmt)-1].startswith(prefix + "-")
+
+def _test_encodings():
+    d = {"a": [1, 2.5, None, "x"], "b": {"c": True}, "p": Path("/foo")}
+    for fmt, (enc, dec) in RESULT_FORMATS.items():
+        assert dec(enc(d)) == {**d, "p": "/foo"}, fmt
+    assert name_matches_prefix("a-b-c.json.gz", "a-b")
+    assert name_matches_prefix("a-b-c.json.gz", "a")
+    assert not name_matches_prefix("a-b-c.json.gz", "a-b-c")
+    assert not name_matches_prefix("a-b-c.txt", "a")
+_test_encodings()
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1<<20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class ResultIndex:
+    """On-disk manifest of the result files in a ResultStorage's resultdir.
+
+    The manifest lives in resultdir/.cache/index.json and maps file name to
+    prefix, size, mtime, ctime and sha256 of the file's content.
+    Adding, removing or renaming a file changes the resultdir's mtime, so as long
+    as the mtime recorded in the manifest matches the current one, the manifest
+    is trusted without listing or stat'ing the directory.
+    Otherwise we rescan, re-using the content hashes of files whose stat data didn't change.
+    A manifest written within RACY_WINDOW_NS of the last directory modification is only trusted
+    if that modification was the add() that wrote it.
+    """
+
+    VERSION = 1
+    # like racy-git: if the manifest was written shortly after the last directory
+    # modification, a subsequent modification may have the same (coarse) mtime
+    RACY_WINDOW_NS = 2 * 10**9
+
     def __init__(self, resultdir):
+        self.resultdir = resultdir
+        self.cachedir = resultdir / ".cache"
+        self.path = self.cachedir / "index.json"
+        self.lockpath = self.cachedir / "index.lock"
+        self._index = None
+
+    @contextlib.contextmanager
+    def locked(self):
+        """exclusive lock against other processes updating the index (and writing results through save_json_result)"""
+        self.cachedir.mkdir(exist_ok=True)
+        with open(self.lockpath, "a") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _dir_mtime_ns(self):
+        return os.stat(self.resultdir).st_mtime_ns
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if index.get("version") != self.VERSION:
+            return None
+        return index
+
+    def _store(self, index):
+        index["written_at_ns"] = time.time_ns()
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def _is_fresh(self, index):
+        if index is None:
+            return False
+        dir_mtime_ns = self._dir_mtime_ns()
+        if index["dir_mtime_ns"] != dir_mtime_ns:
+            return False
+        # the last dir modification was add()'s own write, which the manifest accounts for
+        if index.get("add_dir_mtime_ns") == dir_mtime_ns:
+            return True
+        return index["written_at_ns"] - dir_mtime_ns > self.RACY_WINDOW_NS
+
+    def _rescan(self, old):
+        old_entries = old["entries"] if old else {}
+        # stat the dir before listing so that concurrent modifications are detected next time
+        dir_mtime_ns = self._dir_mtime_ns()
+        entries = {}
+        with os.scandir(self.resultdir) as it:
+            for de in it:
+                if result_file_format(de.name) is None or not de.is_file():
+                    continue
+                st = de.stat()
+                e = {
+                    "prefix": result_filename_prefix(de.name),
+                    "size": st.st_size,
+                    "mtime_ns": st.st_mtime_ns,
+                    "ctime_ns": st.st_ctime_ns,
+                }
+                o = old_entries.get(de.name)
+                if o and all(o[k] == e[k] for k in ["size", "mtime_ns", "ctime_ns"]):
+                    e["sha256"] = o["sha256"]
+                else:
+                    e["sha256"] = sha256_file(de.path)
+                entries[de.name] = e
+        return {"version": self.VERSION, "dir_mtime_ns": dir_mtime_ns, "entries": entries}
+
+    def entries(self):
+        """dict file name => entry, rescanning the resultdir iff the manifest drifted"""
+        if self._index is not None and self._is_fresh(self._index):
+            return self._index["entries"]
+        index = self._load()
+        if not self._is_fresh(index):
+            with self.locked():
+                index = self._load()
+                if not self._is_fresh(index):
+                    index = self._rescan(index)
+                    self._store(index)
+        self._index = index
+        return index["entries"]
+
+    def rescan(self):
+        """force a rescan (e.g. after a result file was modified in place, which doesn't change the dir mtime)"""
+        with self.locked():
+            index = self._rescan(self._load())
+            self._store(index)
+        self._index = index
+
+    def load_if_fresh(self):
+        """the manifest if it reflects the resultdir, None otherwise; must be called with locked() held"""
+        index = self._load()
+        return index if self._is_fresh(index) else None
+
+    def add(self, fresh_index, path, content):
+        """record result file `path` that was just written with bytes `content`
+
+        `fresh_index` is what load_if_fresh() returned before the file was created.
+        Must be called with locked() held.
+        """
+        if fresh_index is None:
+            index = self._rescan(self._load())
+        else:
+            index = fresh_index
+            st = path.stat()
+            index["entries"][path.name] = {
+                "prefix": result_filename_prefix(path.name),
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "ctime_ns": st.st_ctime_ns,
+                "sha256": hashlib.sha256(content).hexdigest(),
+            }
+            index["dir_mtime_ns"] = self._dir_mtime_ns()
+        # the dir mtime observed after our own write, see _is_fresh
+        index["add_dir_mtime_ns"] = index["dir_mtime_ns"]
+        self._store(index)
+        self._index = index
+
+    def entries_with_prefix(self, prefix):
+        return {name: e for name, e in self.entries().items() if name_matches_prefix(name, prefix)}
+
+# top-level keys of result dicts that are identical across many runs (see emit_result in the benchmark scripts)
+DEFAULT_BLOB_KEYS = ["store", "system_setup_data", "pmem_setup_data", "isolcpus_data", "storage_stack"]
+
+BLOB_REF_KEY = "$blob"
+
+def is_blob_ref(v):
+    return isinstance(v, collections.abc.Mapping) and len(v) == 1 and BLOB_REF_KEY in v
+
+@functools.lru_cache(maxsize=1024)
+def _load_blob(blobdir, sha256):
+    p = Path(blobdir) / f"{sha256}.json"
+    try:
+        with open(p, "r") as f:
+            return json.load(f)
+    except FileNotFoundError as e:
+        raise Exception(f"result references blob {sha256} but {p} does not exist") from e
+
+def _blob(blobdir, sha256):
+    # the cached blob is shared between all results that reference it, hand out copies
+    return copy.deepcopy(_load_blob(str(blobdir), sha256))
+
+def hydrate_blobs(d, blobdir):
+    """replace the blob references in result dict `d` with (a private copy of) the blobs' content (in place)"""
+    for k, v in d.items():
+        if is_blob_ref(v):
+            d[k] = _blob(blobdir, v[BLOB_REF_KEY])
+    return d
+
+# dotted paths that notebooks commonly filter on, see ResultStorage.query
+DEFAULT_INDEXED_FIELDS = [
+    "identity",
+    "result.identity",
+    "result.exception",
+    "storage_stack.identity",
+    "storage_stack.fstyp",
+    "storage_stack.mount_dax",
+    "storage_stack.blockdev_stack.identity",
+]
+
+class ResultStorage:
+    def __init__(self, resultdir, blob_keys=DEFAULT_BLOB_KEYS, format="json", indexed_fields=DEFAULT_INDEXED_FIELDS):
+        """`blob_keys`: top-level keys of saved results whose values are stored as content-addressed blobs in resultdir/blobs
+        `format`: encoding of newly saved results, one of RESULT_FORMATS; results in all formats are read
+        `indexed_fields`: dotted paths that are always part of the field index used by query()
+        """
         if not resultdir.is_dir():
             raise Exception(f"resultdir={resultdir} must be a directory")
+        if format not in RESULT_FORMATS:
+            raise Exception(f"unknown format {format!r}, must be one of {list(RESULT_FORMATS.keys())}")
         self.resultdir = resultdir
+        self.format = format
+        self.indexed_fields = list(indexed_fields)
+        self.blobdir = resultdir / "blobs"
+        self.blob_keys = list(blob_keys)
+        self.index = ResultIndex(resultdir)
+
+    def _save_blob(self, value):
+        content = json.dumps(value, sort_keys=True, separators=(",", ":"), default=json_dump_default_to_str).encode("utf-8")
+        sha256 = hashlib.sha256(content).hexdigest()
+        p = self.blobdir / f"{sha256}.json"
+        if not p.exists():
+            self.blobdir.mkdir(exist_ok=True)
+            tmp = p.with_name(f"{p.name}.{os.getpid()}.tmp")
+            with open(tmp, "wb") as f:
+                f.write(content)
+            os.replace(tmp, p)
+        return {BLOB_REF_KEY: sha256}
 
     def save_json_result(self, prefix, result_dict):
-        # https://hynek.me/articles/serialization/
-        @functools.singledispatch
-        def to_serializable(val):
-            return str(val)
-        ## actually we don't need custom serializers for anything, str(Path) is all we need and that's covered by the default case
-        outpath = find_unused_random_filename_in_dir(self.resultdir, prefix + "-{}.json")
-        with open(outpath, "w") as f:
-            json.dump(result_dict, f, default=to_serializable)
-    
-            
-    def iter_results(self, prefix):
-        for filepath in self.resultdir.glob(f"{prefix}-*.json"):
-            with open(filepath, "r") as f:
-                try:
-                    d = json.load(f)
-                except e:
-                    raise Exception(f"cannot process result file {filepath}") from e
-                d["file"] = str(filepath)
-                d['file_ctime'] = filepath.stat().st_ctime
-                yield d
-            
+        result_dict = {k: (self._save_blob(v) if k in self.blob_keys else v) for k, v in result_dict.items()}
+        encode, _ = RESULT_FORMATS[self.format]
+        content = encode(result_dict)
+        with self.index.locked():
+            fresh_index = self.index.load_if_fresh()
+            outpath = find_unused_random_filename_in_dir(self.resultdir, prefix + "-{}." + self.format)
+            with open(outpath, "xb") as f:
+                f.write(content)
+            self.index.add(fresh_index, outpath, content)
+
+    def list_results(self, prefix):
+        """dict file path => index entry (prefix, size, mtime_ns, ctime_ns, sha256) of all results with `prefix`"""
+        return {self.resultdir / name: e for name, e in sorted(self.index.entries_with_prefix(prefix).items())}
+
+    def iter_results(self, prefix, workers=None, projection=None, ordered=True, chunksize=16, hydrate=True, lazy=False):
+        """generator over the decoded results with `prefix`
+
+        If `projection` is given, yields projection(d) instead of d.
+        With `workers` > 1, files are decoded and projected in a pool of that many processes,
+        and only the projected values are sent back; the projection must then be picklable
+        (a module-level function, or a function defined in the notebook, which works
+        because the pool forks after the definition).
+        Files are handed to the workers in chunks of `chunksize`.
+        With `ordered=False`, values are yielded as soon as their chunk completes.
+        With `hydrate=False`, blob references (see blob_keys) are not replaced by the blobs'
+        content, which saves reading and decoding them if they aren't needed.
+        With `lazy=True`, msgpack-encoded results are yielded as read-only LazyResult mappings
+        that only decode the parts that are accessed (results in other formats are decoded eagerly).
+        This is most useful with a projection that only looks at a few fields.
+        """
+        items = list(self.list_results(prefix).items())
+        yield from _iter_items(items, workers, projection, ordered, chunksize, {"hydrate": hydrate, "lazy": lazy})
+
+    def query(self, prefix, where, workers=None, projection=None, ordered=True, chunksize=16, hydrate=True, lazy=False):
+        """like iter_results, but only for results whose dotted paths match `where`
+
+        `where` maps dotted paths to a value (match if equal), a list / tuple / set (match if contained)
+        or a callable (match if it returns True for the value); missing paths have value None.
+        The values of the paths are looked up in the field index (a to_frame cache of
+        indexed_fields plus the paths in `where`), so files that don't match are never opened.
+        The remaining arguments have the same meaning as for iter_results.
+        """
+        paths = sorted(set(self.indexed_fields) | set(where.keys()))
+        cols = ResultFrameCache(self, prefix, paths).refresh_columns(workers)
+        preds = {path: _where_predicate(v) for path, v in where.items()}
+        entries = self.index.entries_with_prefix(prefix)
+        items = []
+        for i, name in enumerate(cols["file"]):
+            if all(pred(cols[path][i]) for path, pred in preds.items()):
+                items.append((self.resultdir / name, entries[name]))
+        yield from _iter_items(items, workers, projection, ordered, chunksize, {"hydrate": hydrate, "lazy": lazy})
+
+    def to_frame(self, prefix, columns, workers=None):
+        """DataFrame with one row per result with `prefix` and one column per dotted path in `columns`
+
+        Missing paths yield None, like dotted.get.
+        The extracted values are cached in a parquet file per (prefix, columns) in resultdir/.cache/frames.
+        Only results that were added or changed since the cache was built are parsed again.
+        Besides `columns`, the frame has the "file" and "file_ctime" columns known from iter_results.
+        `workers` is passed through to the decoding of new results, see iter_results.
+        """
+        columns = list(columns)
+        if len(set(columns)) != len(columns):
+            raise Exception(f"duplicate columns: {columns}")
+        for c in columns:
+            if c in FRAME_META_COLUMNS:
+                raise Exception(f"column name {c!r} is reserved")
+        frame = ResultFrameCache(self, prefix, sorted(columns)).refresh(workers)
+        frame["file"] = frame["file"].map(lambda name: str(self.resultdir / name))
+        return frame[["file", "file_ctime", *columns]]
+
+    def migrate(self, format=None):
+        """re-encode all results in `format` (default: self.format) in place, moving blob_keys into blobs
+
+        Each file keeps its name except for the suffix, and its atime / mtime.
+        Files that are in `format` already and have no blob_keys to move are left alone.
+        Returns the number of converted files.
+        """
+        format = format or self.format
+        encode, _ = RESULT_FORMATS[format]
+        converted = 0
+        with self.index.locked():
+            for de in sorted(os.scandir(self.resultdir), key=lambda de: de.name):
+                fmt = result_file_format(de.name)
+                # e.g. store-savepoint.json isn't a result
+                if fmt is None or result_filename_prefix(de.name) is None or not de.is_file():
+                    continue
+                src = Path(de.path)
+                st = src.stat()
+                d = _load_result_file(src, None, hydrate=False)
+                del d["file"]
+                del d["file_ctime"]
+                to_blob = {k for k, v in d.items() if k in self.blob_keys and not is_blob_ref(v)}
+                if fmt == format and not to_blob:
+                    continue
+                d = {k: (self._save_blob(v) if k in to_blob else v) for k, v in d.items()}
+                dst = src.with_name(src.name[:-len(fmt)] + format)
+                if fmt != format and dst.exists():
+                    # an earlier migration was interrupted after the (atomic) rename
+                    src.unlink()
+                    continue
+                tmp = src.with_name(src.name + f".{os.getpid()}.tmp")
+                with open(tmp, "wb") as f:
+                    f.write(encode(d))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, dst)
+                # the ctime can't be restored
+                os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+                if fmt != format:
+                    src.unlink()
+                converted += 1
+        self.index.rescan()
+        return converted
+
+# formats whose decoded content is msgpack, for LazyResult
+RESULT_FORMATS_MSGPACK_BYTES = {
+    "msgpack": lambda b: b,
+    "msgpack.zst": lambda b: zstandard.ZstdDecompressor().decompress(b),
+}
+
+class LazyResult(LazyMap):
+    """LazyMap of a msgpack-encoded result file that also provides "file" / "file_ctime"
+    and (if `hydrate`) resolves blob references on access"""
+
+    def __init__(self, buf, extra, blobdir, hydrate):
+        super().__init__(buf)
+        self._extra = extra
+        self._blobdir = str(blobdir)
+        self._hydrate = hydrate
+
+    def __getitem__(self, key):
+        if key in self._extra:
+            return self._extra[key]
+        v = super().__getitem__(key)
+        if self._hydrate and is_blob_ref(v):
+            return _blob(self._blobdir, v[BLOB_REF_KEY])
+        return v
+
+    def __iter__(self):
+        yield from self._index()
+        yield from (k for k in self._extra if k not in self._index())
+
+    def __len__(self):
+        return len(set(self._index()) | set(self._extra))
+
+def _load_result_file(filepath, entry, hydrate=True, lazy=False):
+    fmt = result_file_format(filepath.name)
+    with open(filepath, "rb") as f:
+        content = f.read()
+    extra = {
+        "file": str(filepath),
+        "file_ctime": entry["ctime_ns"] / 1e9 if entry else None,
+    }
+    if lazy and fmt in RESULT_FORMATS_MSGPACK_BYTES:
+        return LazyResult(RESULT_FORMATS_MSGPACK_BYTES[fmt](content), extra, filepath.parent / "blobs", hydrate)
+    _, decode = RESULT_FORMATS[fmt]
+    try:
+        d = decode(content)
+    except Exception as e:
+        raise Exception(f"cannot process result file {filepath}") from e
+    if hydrate:
+        hydrate_blobs(d, filepath.parent / "blobs")
+    d.update(extra)
+    return d
+
+def _where_predicate(v):
+    if callable(v):
+        return v
+    if isinstance(v, (list, tuple, set, frozenset)):
+        return lambda x: x in v
+    return lambda x: x == v
+
+def _test_where_predicate():
+    assert _where_predicate(1)(1)
+    assert not _where_predicate(1)(2)
+    assert _where_predicate([1, None])(None)
+    assert _where_predicate(lambda x: x > 3)(4)
+_test_where_predicate()
+
+def _iter_items(items, workers, projection, ordered, chunksize, load_kwargs):
+    if not workers or workers <= 1:
+        for filepath, entry in items:
+            d = _load_result_file(filepath, entry, **load_kwargs)
+            yield projection(d) if projection else d
+        return
+
+    chunks = [items[i:i+chunksize] for i in range(0, len(items), chunksize)]
+    yield from _iter_chunks_parallel(chunks, projection, workers, ordered, load_kwargs)
+
+def _load_chunk(chunk, projection, load_kwargs):
+    ret = []
+    for filepath, entry in chunk:
+        d = _load_result_file(filepath, entry, **load_kwargs)
+        ret.append(projection(d) if projection else d)
+    return ret
+
+def _iter_chunks_parallel(chunks, projection, workers, ordered, load_kwargs):
+    # bound the number of chunks in flight so that we stream instead of decoding everything up front
+    max_inflight = 2 * workers
+    chunks = iter(chunks)
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    inflight = collections.deque()
+    try:
+        def submit_more():
+            while len(inflight) < max_inflight:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                inflight.append(executor.submit(_load_chunk, chunk, projection, load_kwargs))
+        submit_more()
+        while inflight:
+            if ordered:
+                f = inflight.popleft()
+            else:
+                done, _ = concurrent.futures.wait(inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+                f = next(iter(done))
+                inflight.remove(f)
+            values = f.result()
+            submit_more()
+            yield from values
+    finally:
+        # the consumer may stop iterating early
+        for f in inflight:
+            f.cancel()
+        executor.shutdown(wait=True)
+
+FRAME_META_COLUMNS = ["file", "sha256", "file_ctime"]
+
+def _frame_column_to_arrow(values):
+    """returns (array, is_json_encoded)"""
+    if any(isinstance(v, (dict, list)) for v in values):
+        # nested values don't map well onto arrow structs (keys vary between results)
+        return pa.array([json.dumps(v) for v in values], type=pa.string()), True
+    try:
+        return pa.array(values), False
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # mixed types, e.g. str and int
+        return pa.array([json.dumps(v) for v in values], type=pa.string()), True
+
+def _project_frame_row(columns, d):
+    return {"file_ctime": d["file_ctime"], **{c: materialize(dotted.get(d, c)) for c in columns}}
+
+class ResultFrameCache:
+    """parquet file with the values of the dotted paths `columns` for all results with `prefix`"""
+
+    VERSION = 1
+
+    def __init__(self, result_storage, prefix, columns):
+        self.result_storage = result_storage
+        self.prefix = prefix
+        self.columns = columns
+        key = hashlib.sha256(json.dumps([self.VERSION, columns]).encode("utf-8")).hexdigest()[:16]
+        self.path = result_storage.index.cachedir / "frames" / f"{prefix}--{key}.parquet"
+
+    def _load(self):
+        """cached rows as dict column => list of values, None if there is no usable cache"""
+        try:
+            table = pq.read_table(self.path)
+        except (FileNotFoundError, pa.ArrowInvalid):
+            return None
+        meta = json.loads(table.schema.metadata[b"resultstorage"])
+        if meta["version"] != self.VERSION or meta["columns"] != self.columns:
+            return None
+        cols = table.to_pydict()
+        for c in meta["json_columns"]:
+            cols[c] = [json.loads(v) for v in cols[c]]
+        return cols
+
+    def _store(self, cols):
+        arrays = {}
+        json_columns = []
+        for c in [*FRAME_META_COLUMNS, *self.columns]:
+            arrays[c], is_json = _frame_column_to_arrow(cols[c])
+            if is_json:
+                json_columns += [c]
+        table = pa.table(arrays)
+        meta = {"version": self.VERSION, "columns": self.columns, "json_columns": json_columns}
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"resultstorage": json.dumps(meta)})
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        pq.write_table(table, tmp)
+        os.replace(tmp, self.path)
+
+    def refresh(self, workers=None):
+        return pd.DataFrame(self.refresh_columns(workers))
+
+    def refresh_columns(self, workers=None):
+        """like refresh, but returns dict column => list of values"""
+        entries = self.result_storage.index.entries_with_prefix(self.prefix)
+
+        cached = self._load()
+        cols = {c: [] for c in [*FRAME_META_COLUMNS, *self.columns]}
+        have = set()
+        modified = cached is None
+        if cached is not None:
+            for i, (name, sha256) in enumerate(zip(cached["file"], cached["sha256"])):
+                e = entries.get(name)
+                if e is None or e["sha256"] != sha256:
+                    modified = True # removed or changed
+                    continue
+                have.add(name)
+                for c in cols.keys():
+                    cols[c].append(cached[c][i])
+        del cached
+
+        missing = [(self.result_storage.resultdir / name, e) for name, e in sorted(entries.items()) if name not in have]
+        if missing:
+            modified = True
+            chunks = [missing[i:i+16] for i in range(0, len(missing), 16)]
+            projection = functools.partial(_project_frame_row, self.columns)
+            if workers and workers > 1:
+                rows = _iter_chunks_parallel(chunks, projection, workers, True, {"lazy": True})
+            else:
+                rows = (r for chunk in chunks for r in _load_chunk(chunk, projection, {"lazy": True}))
+            for i, row in enumerate(rows):
+                filepath, e = missing[i]
+                cols["file"].append(filepath.name)
+                cols["sha256"].append(e["sha256"])
+                for c, v in row.items():
+                    cols[c].append(v)
+
+        if modified:
+            self._store(cols)
+        return cols
+
+def main():
+    parser = argparse.ArgumentParser(description="maintenance operations on a ResultStorage result directory")
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate = sub.add_parser("migrate", help="re-encode all results in place")
+    migrate.add_argument("--format", required=True, choices=RESULT_FORMATS.keys())
+    migrate.add_argument("resultdir", type=Path)
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        n = ResultStorage(args.resultdir, format=args.format).migrate()
+        print(f"converted {n} result files to {args.format}")
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 from schema import Schema, Or, And
-from .helpers import AttrDict
+from .helpers import AttrDict, StreamingProcess
 import re
 from pathlib import Path
 import subprocess
@@ -104,17 +104,21 @@ def run(config):
     ]
 
     print(f"running db_bench: {args}")
+    # stream so that db_bench's progress (stderr) is visible while it runs, stdout is needed in full for the results
+    stdout = []
     try:
         start = time.monotonic()
-        cp = subprocess.run(args, check=True, capture_output=True, text=True)
+        with StreamingProcess(args, merge_stderr=False, sep=rb"[\r\n]") as p:
+            stdout.extend(p)
         runtime = time.monotonic() - start
     except subprocess.CalledProcessError as e:
         raise Exception(f"error running db_bench:\n{e.stderr}") from e
+    stdout = "".join(stdout)
 
-    metrics = extract_benchmark_results(cp.stdout)
+    metrics = extract_benchmark_results(stdout)
 
     return {
-        "stdout": cp.stdout,
+        "stdout": stdout,
         "git_describe": git_describe.stdout,
         "runtime": runtime,
         "metrics": metrics,
@@ -6,6 +6,8 @@ from .helpers import must_run, poll_wait, deep_copy_dict
 import subprocess
 from schema import Schema
 
+ZfsPropertySchema = Schema({"prop": str, "value": str})
+
 class ZFS:
     def __init__(self, store, identity):
         self.store = store
@@ -21,7 +23,8 @@ class ZFS:
         return False
 
     def __enter__(self):
-        config = self._make_config()
+        # not part of _make_config() / as_dict(), they don't change the resulting setup
+        config = {**self._make_config(), "module_reload": "if_needed", "pool_lease": True}
         assert self.blockdev_path is None
         assert self.open_setup is None
         self.open_setup = lib.zfssetup.setup_openzfs(config)
@@ -33,7 +36,7 @@ class ZFS:
         self.open_setup = None
 
     def _set_zfs_property(self, **kwargs):
-        kwargs = Schema({"prop": str, "value": str}).validate(kwargs)
+        kwargs = ZfsPropertySchema.validate(kwargs)
         self._filesystem_properties[kwargs["prop"]] = kwargs["value"]
 
     def _make_config(self):
@@ -162,6 +165,7 @@ class DevBlockdev:
         return False
 
     def __enter__(self):
+        lib.zfssetup.release_leased_pool() # the pool's vdevs are our devices
         assert self.path.is_block_device()
         assert self.open is False
         self.open = True
@@ -195,6 +199,7 @@ class DevPmem:
         return True
 
     def __enter__(self):
+        lib.zfssetup.release_leased_pool() # the pool's log vdev is our device
         assert self.dev is None
         self.dev = Path(self.store.get_first("fsdax"))
         assert self.dev.is_block_device()
@@ -438,3 +443,132 @@ class Ext4(LinuxFilesystem):
     def has_o_dax():
         return True
 
+
+class SharedLayer:
+    """wraps a lower storage stack layer (e.g. a LinuxFilesystem's blockdev_stack) so that it is set up once
+    and torn down only after the last upper layer using it exited, see schedule_stacks()
+    """
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.refs = 0
+        self.entered = None
+
+    def __getattr__(self, name):
+        if name == "layer": # not yet set, e.g. during copy / unpickling
+            raise AttributeError(name)
+        return getattr(self.layer, name)
+
+    def _get(self):
+        if self.entered is None:
+            self.entered = self.layer.__enter__()
+        self.refs += 1
+        return self.entered
+
+    def _put(self, type=None, val=None, bt=None):
+        assert self.refs > 0
+        self.refs -= 1
+        if self.refs == 0 and self.entered is not None:
+            self.entered = None
+            self.layer.__exit__(type, val, bt)
+
+    def __enter__(self):
+        return self._get()
+
+    def __exit__(self, type, val, bt):
+        self._put(type, val, bt)
+
+    @contextlib.contextmanager
+    def hold(self):
+        """keep the layer alive (once set up by an upper layer) until the context is left"""
+        self.refs += 1
+        try:
+            yield
+        finally:
+            self._put()
+
+def _lower_layers(stack):
+    if hasattr(stack, "blockdev_stack"):
+        lower = stack.blockdev_stack
+        return [*_lower_layers(lower), lower]
+    return []
+
+def _layer_key(layer):
+    return id(layer.layer) if isinstance(layer, SharedLayer) else id(layer)
+
+class StackSchedule:
+    """iterate `stacks` grouped by shared lower layers, keeping each shared layer alive for its group
+
+    Stacks that share lower layer objects (e.g. XFS and Ext4 on the same ZFS zvol stack) become consecutive,
+    ordered by first appearance, so each shared layer is set up once instead of once per upper layer.
+    Shared lower layers are wrapped in SharedLayer, as_dict() etc. are unaffected.
+
+        with StackSchedule(fs_stacks) as stacks:
+            for s in stacks:
+                with s as s: ...
+    """
+
+    def __init__(self, stacks):
+        shared = {}
+        for s in stacks:
+            if hasattr(s, "blockdev_stack") and not isinstance(s.blockdev_stack, SharedLayer):
+                k = id(s.blockdev_stack)
+                if k not in shared:
+                    shared[k] = SharedLayer(s.blockdev_stack)
+                s.blockdev_stack = shared[k]
+
+        first_seen = {}
+        def key(s):
+            return tuple(first_seen.setdefault(_layer_key(l), len(first_seen)) for l in _lower_layers(s))
+        keys = [key(s) for s in stacks] # in input order, so that first_seen is too
+        order = sorted(range(len(stacks)), key=lambda i: keys[i] or (len(first_seen) + i,))
+        self.stacks = [stacks[i] for i in order]
+        self._held = contextlib.ExitStack()
+
+    def __iter__(self):
+        current = None
+        for s in self.stacks:
+            lower = getattr(s, "blockdev_stack", None)
+            if lower is not current:
+                self._held.close()
+                if isinstance(lower, SharedLayer):
+                    self._held.enter_context(lower.hold())
+                current = lower
+            yield s
+        self._held.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, val, bt):
+        self._held.close()
+
+def _test_stack_schedule():
+    log = []
+    class Layer:
+        def __init__(self, name, blockdev_stack=None):
+            self.name = name
+            if blockdev_stack is not None:
+                self.blockdev_stack = blockdev_stack
+        def __enter__(self):
+            log.append(f"+{self.name}")
+            if hasattr(self, "blockdev_stack"):
+                self._lower = self.blockdev_stack.__enter__()
+            return self
+        def __exit__(self, *exc):
+            if hasattr(self, "blockdev_stack"):
+                self.blockdev_stack.__exit__(*exc)
+            log.append(f"-{self.name}")
+    a, b = Layer("a"), Layer("b")
+    stacks = [Layer("xfs_a", a), Layer("xfs_b", b), Layer("zfs"), Layer("ext4_a", a), Layer("ext4_b", b)]
+    with StackSchedule(stacks) as scheduled:
+        for s in scheduled:
+            with s:
+                pass
+    assert log == [
+        "+xfs_a", "+a", "-xfs_a", "+ext4_a", "-ext4_a", "-a",
+        "+xfs_b", "+b", "-xfs_b", "+ext4_b", "-ext4_b", "-b",
+        "+zfs", "-zfs",
+    ], log
+    assert a.__class__ is Layer and isinstance(stacks[0].blockdev_stack, SharedLayer)
+_test_stack_schedule()
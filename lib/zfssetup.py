@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
 from pathlib import Path
+import atexit
+import concurrent.futures
+import json
+import os
 import subprocess
-import time
 from schema import Schema, Optional, Or
-from .helpers import assert_allowed_keys, must_run, string_with_one_format_placeholder
+from .helpers import assert_allowed_keys, must_run, string_with_one_format_placeholder, wait_for_path, CachedSchema
 import contextlib
 
 def flagdict_to_argv(flag: str, flagdict: dict):
@@ -14,7 +17,7 @@ def flagdict_to_argv(flag: str, flagdict: dict):
     return argv
 
 
-ConfigSchema = Schema({
+ConfigSchema = CachedSchema(Schema({
     "builddir": Path,
     Optional("module_args", default={}): {
         str: Or({},{
@@ -38,12 +41,223 @@ ConfigSchema = Schema({
         "count": int,
         "size": str,
         "volblocksize": int,
-    })
-})
+    }),
+    # always: unload + insmod on setup, unload on teardown
+    # if_needed: keep the loaded modules if they are from `builddir` and the module_args can be applied at runtime
+    #            (see RUNTIME_MODULE_PARAMS), leave them loaded on teardown
+    Optional("module_reload", default="always"): Or("always", "if_needed"),
+    # keep the pool on teardown, the next setup with the same pool layout resets it instead of creating a new one,
+    # see release_leased_pool()
+    Optional("pool_lease", default=False): bool,
+}))
+
+MODS_IN_TOPO_ORDER = [
+        ("spl","module/spl/spl.ko"),
+        ("zavl","module/avl/zavl.ko"),
+        ("znvpair","module/nvpair/znvpair.ko"),
+        ("zunicode","module/unicode/zunicode.ko"),
+        ("zcommon","module/zcommon/zcommon.ko"),
+        ("zlua","module/lua/zlua.ko"),
+        ("zzstd","module/zstd/zzstd.ko"),
+        ("icp","module/icp/icp.ko"),
+        ("zfs","module/zfs/zfs.ko"),
+]
+
+SYS_MODULE = Path("/sys/module")
+
+# what we know about the currently loaded modules, /run is cleared on reboot
+# {"builddir": str, "load_args": {mod: {param: value}}, "runtime_defaults": {mod: {param: value before we first wrote it}}}
+MODULE_STATE_PATH = Path("/run/zfssetup_modules.json")
+
+def _read_module_state():
+    try:
+        return json.loads(MODULE_STATE_PATH.read_text())
+    except FileNotFoundError:
+        return None
+
+def _write_module_state(state):
+    tmp = MODULE_STATE_PATH.with_name(MODULE_STATE_PATH.name + ".tmp")
+    tmp.write_text(json.dumps(state))
+    os.replace(tmp, MODULE_STATE_PATH)
+
+def _ko_srcversion(ko: Path):
+    return must_run(["modinfo", "-F", "srcversion", ko]).stdout.decode("utf-8").strip()
+
+def _loaded_srcversion(mod, sys_module=SYS_MODULE):
+    p = sys_module / mod / "srcversion"
+    return p.read_text().strip() if p.exists() else None
+
+def _param_path(mod, param, sys_module=SYS_MODULE):
+    return sys_module / mod / "parameters" / param
+
+def _loaded_param(mod, param, sys_module=SYS_MODULE):
+    """current value of a loaded module's parameter, None if sysfs doesn't expose it readably"""
+    try:
+        return _param_path(mod, param, sys_module).read_text().strip()
+    except (FileNotFoundError, PermissionError):
+        return None
+
+# module parameters that are known to take effect when written to sysfs
+# (a writable sysfs file doesn't mean that: many tunables are only read at module init, pool import or ZIL open)
+RUNTIME_MODULE_PARAMS = {
+    "zfs": {
+        "zvol_request_sync", # read on every zvol request
+    },
+}
+
+def _param_applies_at_runtime(mod, param, sys_module=SYS_MODULE):
+    if param not in RUNTIME_MODULE_PARAMS.get(mod, set()):
+        return False
+    p = _param_path(mod, param, sys_module)
+    return p.exists() and (p.stat().st_mode & 0o222) != 0
+
+def module_reload_plan(state, builddir: Path, module_args, loaded_srcversion=_loaded_srcversion, ko_srcversion=_ko_srcversion, param_applies_at_runtime=_param_applies_at_runtime, loaded_param=_loaded_param):
+    """None if the modules need to be (re)loaded, else {mod: {param: value}} to write to /sys/module/<mod>/parameters
+
+    Load-time parameters are compared against the loaded module's sysfs values (the state's load_args only if sysfs
+    doesn't expose them), so modules that were reloaded behind our back don't keep wrong parameters.
+    Parameters that an earlier setup set but `module_args` doesn't are restored to their default,
+    which we only know for parameters that we changed at runtime.
+    """
+    if state is None or state["builddir"] != str(builddir):
+        return None
+    for mod, modrelpath in MODS_IN_TOPO_ORDER:
+        loaded = loaded_srcversion(mod)
+        if loaded is None or loaded != ko_srcversion(builddir / modrelpath):
+            return None
+    writes = {}
+    for mod, _ in MODS_IN_TOPO_ORDER:
+        want = module_args.get(mod, {})
+        load_args = state["load_args"].get(mod, {})
+        defaults = state["runtime_defaults"].get(mod, {})
+        for param in sorted(set(want) | set(load_args) | set(defaults)):
+            if param in want:
+                value = want[param]
+            elif param in defaults:
+                value = defaults[param]
+            else:
+                return None # passed to insmod, default unknown
+            if not param_applies_at_runtime(mod, param):
+                current = loaded_param(mod, param)
+                if current is None:
+                    current = load_args.get(param)
+                if current != value:
+                    return None
+                continue
+            writes.setdefault(mod, {})[param] = value
+    return writes
+
+def _apply_module_params(state, writes):
+    for mod, params in writes.items():
+        defaults = state["runtime_defaults"].setdefault(mod, {})
+        load_args = state["load_args"].get(mod, {})
+        for param, value in params.items():
+            p = _param_path(mod, param)
+            current = p.read_text().strip()
+            if param not in load_args and param not in defaults:
+                defaults[param] = current
+            if current != value:
+                print(f"setting module parameter {mod}.{param}={value} (was {current})")
+                p.write_text(value)
+    _write_module_state(state)
+
+def _test_module_reload_plan():
+    builddir = Path("/build")
+    state = {"builddir": "/build", "load_args": {"zfs": {"zil_default_kind": "1"}}, "runtime_defaults": {"zfs": {"zvol_request_sync": "0"}}}
+    same = dict(loaded_srcversion=lambda mod: "v", ko_srcversion=lambda ko: "v", loaded_param=lambda mod, param: None)
+    runtime = lambda mod, param: param != "zil_default_kind"
+    def plan(state, args, **kwargs):
+        return module_reload_plan(state, builddir, args, **{**same, "param_applies_at_runtime": runtime, **kwargs})
+
+    assert plan(state, {"zfs": {"zil_default_kind": "1", "zvol_request_sync": "1"}}) == {"zfs": {"zvol_request_sync": "1"}}
+    # runtime param not requested anymore => restore default
+    assert plan(state, {"zfs": {"zil_default_kind": "1"}}) == {"zfs": {"zvol_request_sync": "0"}}
+    # load-time-only param differs
+    assert plan(state, {"zfs": {"zil_default_kind": "2"}}) is None
+    assert plan(state, {}) is None
+    # different build
+    assert plan(state, {"zfs": {"zil_default_kind": "1"}}, ko_srcversion=lambda ko: "w") is None
+    assert plan(None, {}) is None
+    assert plan({**state, "builddir": "/other"}, {"zfs": {"zil_default_kind": "1"}}) is None
+    # writable param that was passed to insmod, now unspecified => default unknown
+    state2 = {"builddir": "/build", "load_args": {"zfs": {"zvol_request_sync": "1"}}, "runtime_defaults": {}}
+    assert plan(state2, {}) is None
+    assert plan(state2, {"zfs": {"zvol_request_sync": "0"}}) == {"zfs": {"zvol_request_sync": "0"}}
+    # sysfs wins over the state file's load_args (e.g. modules reloaded by hand)
+    sysfs = lambda value: (lambda mod, param: value if param == "zil_default_kind" else None)
+    assert plan(state, {"zfs": {"zil_default_kind": "1"}}, loaded_param=sysfs("2")) is None
+    assert plan(state, {"zfs": {"zil_default_kind": "2"}}, loaded_param=sysfs("2")) == {"zfs": {"zvol_request_sync": "0"}}
+    # not on the allowlist => reload, whatever sysfs says
+    assert not _param_applies_at_runtime("zfs", "zfs_zil_pmem_prb_ncommitters")
+
+_test_module_reload_plan()
+def _get_pool_guid(zpool_binary, poolname):
+    guid = str(must_run([zpool_binary, "get", "-H", "-p", "-o", "value",  "guid", poolname]).stdout).strip()
+    return guid
+
+def _destroy_pool(zpool_binary, poolname, guid):
+    # check pool guid to ensure that we only destroy pools that we created
+    currentguid = _get_pool_guid(zpool_binary, poolname)
+    if currentguid == guid:
+        must_run([zpool_binary, "destroy", poolname]) # takes care of unmounting
+    else:
+        raise Exception(f"expecting to destroy pool {poolname} with guid {guid} but has guid {currentguid}")
+
+# bound on concurrent zfs / mount.zfs invocations
+# (dataset creations that run concurrently end up in the same txg instead of waiting for one txg sync each)
+MAX_WORKERS = 8
+
+def _map_parallel(fn, items):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(executor.map(fn, items))
+
+# snapshot of all datasets and zvols of a pool_lease pool right after creation
+EMPTY_SNAPSHOT = "zfssetup_empty"
+
+# pool that a pool_lease setup kept after teardown, reused by the next setup with the same layout
+_leased_pool = None
+
+def _pool_layout(config):
+    """a leased pool is reused if this matches, only filesystem_properties may differ
+
+    module_args are part of it: some are only read at pool import / ZIL open, a reused pool would keep the old values.
+    """
+    keys = ["builddir", "module_args", "poolname", "pool_properties", "mountpoint", "vdevs", "create_child_datasets", "create_child_zvols"]
+    return json.dumps({k: config[k] for k in keys}, sort_keys=True, default=str)
+
+def release_leased_pool():
+    """destroy the pool kept by a pool_lease setup, if any
+
+    Call this before using the pool's vdevs for something else.
+    """
+    global _leased_pool
+    if _leased_pool is None:
+        return
+    lease, _leased_pool = _leased_pool, None
+    print(f"destroying leased pool {lease['poolname']}")
+    _destroy_pool(lease["zpool_binary"], lease["poolname"], lease["guid"])
+
+atexit.register(release_leased_pool)
+
+def _reset_leased_pool(zfs_binary, poolname, lease, filesystem_properties):
+    # roll back what was written since the pool was created
+    written = must_run([zfs_binary, "get", "-H", "-p", "-r", "-t", "filesystem,volume", "-o", "name,value", f"written@{EMPTY_SNAPSHOT}", poolname]).stdout
+    written = [line.split("\t") for line in written.decode("utf-8").splitlines()]
+    _map_parallel(
+        lambda ds: must_run([zfs_binary, "rollback", "-r", f"{ds}@{EMPTY_SNAPSHOT}"]),
+        [ds for ds, nbytes in written if int(nbytes) > 0])
+    # properties were set on the root dataset with `zpool create -O`, children inherit them
+    leased_properties = lease["filesystem_properties"]
+    for prop, value in filesystem_properties.items():
+        if leased_properties.get(prop) != value:
+            must_run([zfs_binary, "set", f"{prop}={value}", poolname])
+    for prop in leased_properties.keys() - filesystem_properties.keys():
+        must_run([zfs_binary, "inherit", prop, poolname])
 
 # Driver: OpenZFS 0.8 and forward-compatible driver
 @contextlib.contextmanager
 def setup_openzfs(config):
+    global _leased_pool
     config = ConfigSchema.validate(config)
 
     builddir = config["builddir"]
@@ -64,38 +278,104 @@ def setup_openzfs(config):
     poolname = config["poolname"]
     assert type(poolname) is str and len(poolname) > 0
 
-    # unload + reload module with correct module params
-    mods_in_topo_order = [
-            ("spl","module/spl/spl.ko"),
-            ("zavl","module/avl/zavl.ko"),
-            ("znvpair","module/nvpair/znvpair.ko"),
-            ("zunicode","module/unicode/zunicode.ko"),
-            ("zcommon","module/zcommon/zcommon.ko"),
-            ("zlua","module/lua/zlua.ko"),
-            ("zzstd","module/zstd/zzstd.ko"),
-            ("icp","module/icp/icp.ko"),
-            ("zfs","module/zfs/zfs.ko"),
-    ]
+    if config["pool_lease"] and config["module_reload"] == "always":
+        raise Exception("pool_lease requires module_reload=if_needed")
+
+    lease = None
+    if _leased_pool is not None and _leased_pool["layout"] == _pool_layout(config):
+        lease = _leased_pool
+    else:
+        release_leased_pool()
+
+    # (re)load modules with correct module params
+    mods_in_topo_order = MODS_IN_TOPO_ORDER
     module_args = config.get("module_args", {})
     assert_allowed_keys(module_args, map(lambda p: p[0], mods_in_topo_order))
     def unload_modules():
+        if MODULE_STATE_PATH.exists():
+            MODULE_STATE_PATH.unlink()
         for mod, _ in reversed(mods_in_topo_order):
             print(f"removing module {mod}")
-            if not (Path("/sys/module") / mod).exists():
+            if not (SYS_MODULE / mod).exists():
                 continue
             must_run(["rmmod",  mod])
-            assert not (Path("/sys/module") / mod).exists()
-    unload_modules()
-    for mod, modrelpath in mods_in_topo_order:
-        modparams = [f"{k}={v}" for k,v in module_args.get(mod, {}).items()]
-        must_run(["insmod", builddir / Path(modrelpath) , *modparams])
+            assert not (SYS_MODULE / mod).exists()
+    module_state = _read_module_state()
+    plan = None
+    if config["module_reload"] == "if_needed":
+        plan = module_reload_plan(module_state, builddir, module_args)
+    if plan is not None:
+        print(f"keeping loaded zfs modules, setting module parameters {plan}")
+        _apply_module_params(module_state, plan)
+    else:
+        release_leased_pool() # can't unload the modules with the pool imported
+        lease = None
+        unload_modules()
+        for mod, modrelpath in mods_in_topo_order:
+            modparams = [f"{k}={v}" for k,v in module_args.get(mod, {}).items()]
+            must_run(["insmod", builddir / Path(modrelpath) , *modparams])
+        _write_module_state({"builddir": str(builddir), "load_args": module_args, "runtime_defaults": {}})
 
-    # create pool
-    vdevs = config["vdevs"]
-    assert type(vdevs) is list and len(vdevs) > 0
     filesystem_properties = config["filesystem_properties"]
     assert "mountpoint" not in filesystem_properties.keys()
     filesystem_properties["mountpoint"] = "legacy"
+
+    if lease is not None:
+        print(f"reusing leased pool {poolname}")
+        _leased_pool = None # ours now, destroyed on teardown unless we lease it again
+        guid = lease["guid"]
+        def prepare_pool():
+            currentguid = _get_pool_guid(zpool_binary, poolname)
+            if currentguid != guid:
+                raise Exception(f"expecting leased pool {poolname} with guid {guid} but has guid {currentguid}")
+            _reset_leased_pool(zfs_binary, poolname, lease, filesystem_properties)
+    else:
+        guid = _create_pool(config, zpool_binary, filesystem_properties)
+        prepare_pool = lambda: _populate_pool(config, zfs_binary, mountzfs_binary)
+    try:
+        prepare_pool()
+    except:
+        # a pool that is neither leased nor destroyed would stay around until someone notices
+        try:
+            _destroy_pool(zpool_binary, poolname, guid)
+        except Exception as e:
+            print(f"failed to destroy pool {poolname} after failed setup: {e}")
+        raise
+
+    try:
+        yield { "pool_guid": guid }
+    finally:
+        if config["pool_lease"]:
+            # lease first so that release_leased_pool() (at the latest at exit) destroys it if the checks below fail
+            _leased_pool = {
+                "layout": _pool_layout(config),
+                "zpool_binary": zpool_binary,
+                "poolname": poolname,
+                "guid": guid,
+                "filesystem_properties": filesystem_properties,
+            }
+            try:
+                currentguid = _get_pool_guid(zpool_binary, poolname)
+                if currentguid != guid:
+                    raise Exception(f"expecting to lease pool {poolname} with guid {guid} but has guid {currentguid}")
+            except:
+                try:
+                    release_leased_pool()
+                except Exception as e:
+                    print(f"failed to destroy pool {poolname} after failed lease: {e}")
+                raise
+        else:
+            _destroy_pool(zpool_binary, poolname, guid)
+            if config["module_reload"] == "always":
+                unload_modules()
+
+def _create_pool(config, zpool_binary, filesystem_properties):
+    """=> pool guid"""
+    poolname = config["poolname"]
+
+    # create pool
+    vdevs = config["vdevs"]
+    assert type(vdevs) is list and len(vdevs) > 0
     zpool_create_cmd = [zpool_binary, "create", "-f",
         *flagdict_to_argv("-O", filesystem_properties),
         *flagdict_to_argv("-o", config["pool_properties"]),
@@ -103,11 +383,11 @@ def setup_openzfs(config):
     must_run(zpool_create_cmd)
 
     # get pool metadata
-    def get_pool_guid(poolname):
-        guid = str(must_run([zpool_binary, "get", "-H", "-p", "-o", "value",  "guid", poolname]).stdout).strip()
-        return guid
+    return _get_pool_guid(zpool_binary, poolname)
 
-    guid = get_pool_guid(poolname)
+def _populate_pool(config, zfs_binary, mountzfs_binary):
+    poolname = config["poolname"]
+    mountpoint = config["mountpoint"]
 
     # mount pool (child datasets need it mounted)
     must_run([mountzfs_binary, poolname, mountpoint])
@@ -124,12 +404,13 @@ def setup_openzfs(config):
         count = int(create_child_datasets["count"])
         assert count >= 0
 
-        for i in range(0, count):
+        def create_dataset(i):
             ds = poolname + "/" + name_format_str.format(i)
             must_run([zfs_binary, "create", "-o", "mountpoint=legacy", ds])
             ds_mp = mountpoint / dirname_format_str.format(i)
             ds_mp.mkdir()
             must_run([mountzfs_binary, ds, ds_mp])
+        _map_parallel(create_dataset, range(0, count))
 
     # create child zvols if requested
     create_child_zvols = config["create_child_zvols"]
@@ -141,28 +422,18 @@ def setup_openzfs(config):
         assert count >= 0
         size = create_child_zvols["size"]
 
-        zvol_paths = []
-        for i in range(0, count):
+        def create_zvol(i):
             ds = poolname + "/" + name_format_str.format(i)
             must_run([zfs_binary, "create", "-V", size, "-o", f"volblocksize={create_child_zvols['volblocksize']}", ds])
-            zvol_paths += [Path(f"/dev/zvol/{ds}")]
+            return Path(f"/dev/zvol/{ds}")
+        zvol_paths = _map_parallel(create_zvol, range(0, count))
+        # zfs creates the zvol minors asynchronously, udev then creates the /dev/zvol links
         for p in zvol_paths:
-            while True:
-                if p.is_block_device():
-                    break
-                else:
-                    time.sleep(0.1)
+            wait_for_path(p, what=f"zvol {p} to appear")
+            assert p.is_block_device()
 
-    try:
-        yield { "pool_guid": guid }
-    finally:
-        # check pool guid to ensure that we only destroy pools that we created
-        currentguid = get_pool_guid(poolname)
-        if currentguid == guid:
-            must_run([zpool_binary, "destroy", poolname]) # takes care of unmounting
-        else:
-            raise Exception("expecting to destroy pool {poolname} with guid {guid} but has guid {currentguid}")
-        unload_modules() # always
+    if config["pool_lease"]:
+        must_run([zfs_binary, "snapshot", "-r", f"{poolname}@{EMPTY_SNAPSHOT}"])
 
 
 ## Driver common entry point